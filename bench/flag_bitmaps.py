@@ -0,0 +1,62 @@
+"""Benchmark for searching by flags: local bitmaps vs Dovecot SORT
+
+Runs against "All" box of given user, so Dovecot should be up.
+
+Usage:
+  python bench/flag_bitmaps.py <login> [<count>]
+"""
+import pathlib
+import sys
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from mailur import conf, index, local  # noqa
+
+queries = [
+    'all',
+    'unkeyword #trash unkeyword #spam',
+    'keyword #inbox unkeyword #trash unkeyword #spam',
+    'keyword #inbox unseen unkeyword #trash unkeyword #spam',
+    'keyword #inbox unseen flagged unkeyword #trash unkeyword #spam',
+    'keyword #sent unkeyword #trash unkeyword #spam',
+    'uid 1:1000 seen',
+]
+
+
+def bench(fn, count):
+    start = time.perf_counter()
+    for i in range(count):
+        res = fn()
+    return res, (time.perf_counter() - start) / count
+
+
+def main(login, count=10):
+    conf['USER'] = login
+    with local.client() as con:
+        start = time.perf_counter()
+        bitmaps = index.Bitmaps()
+        local.update_bitmaps(con, bitmaps)
+        print('## %s messages, %s flags, built in %.3fs' % (
+            len(bitmaps.uids(bitmaps.exists)), len(bitmaps.flags),
+            time.perf_counter() - start
+        ))
+
+        for q in queries:
+            terms = index.Bitmaps.parse(q)
+            dovecot, spent_dovecot = bench(
+                lambda: con.sort('(REVERSE DATE)', q)[0].decode().split(),
+                count
+            )
+            local_, spent_local = bench(
+                lambda: bitmaps.uids(bitmaps.search(terms), reverse=True),
+                count
+            )
+            print('%-64s %8s dovecot=%.4fs bitmaps=%.4fs %s' % (
+                q, len(dovecot), spent_dovecot, spent_local,
+                'ok' if local_ == dovecot else 'DIFFERENT'
+            ))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1], *[int(i) for i in sys.argv[2:]])
@@ -0,0 +1,62 @@
+"""Microbenchmark for parsing of FETCH responses
+
+Usage:
+  python bench/imap_fetch.py [<count>]
+"""
+import json
+import pathlib
+import re
+import sys
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from mailur import imap  # noqa
+
+
+def response(count):
+    meta = json.dumps({'origin_uid': '1', 'date': 1500000000}).encode()
+    res = []
+    for i in range(1, count + 1):
+        res.extend([
+            (
+                b'%d (UID %d MODSEQ (%d) FLAGS (\\Seen #latest #inbox) '
+                b'BINARY[1] {%d}' % (i, i, i * 3, len(meta)),
+                meta
+            ),
+            b')'
+        ])
+    return res
+
+
+def with_regex(res):
+    # the way local.py used to parse responses
+    for i in range(0, len(res), 2):
+        uid, flags = re.search(
+            r'UID (\d+) MODSEQ \(\d+\) FLAGS \(([^)]*)\)', res[i][0].decode()
+        ).groups()
+        yield uid, flags.split(), res[i][1]
+
+
+def with_records(res):
+    for msg in imap.parse_fetch(res):
+        yield msg.uid, msg.flags, msg.body
+
+
+def bench(name, fn, res, count):
+    start = time.perf_counter()
+    for i in fn(res):
+        pass
+    spent = time.perf_counter() - start
+    print('%-14s %8.3fs %10.0f msgs/s' % (name, spent, count / spent))
+
+
+def main(count=100000):
+    res = response(count)
+    print('## %s messages' % count)
+    bench('regex', with_regex, res, count)
+    bench('parse_fetch', with_records, res, count)
+
+
+if __name__ == '__main__':
+    main(*[int(i) for i in sys.argv[1:]])
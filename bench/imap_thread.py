@@ -0,0 +1,88 @@
+"""Benchmark for parsing of THREAD responses
+
+Usage:
+  python bench/imap_thread.py [<count>...]
+"""
+import pathlib
+import random
+import sys
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from mailur import imap  # noqa
+
+
+def response(count, seed=42):
+    rnd = random.Random(seed)
+
+    def thread(uids):
+        if len(uids) == 1:
+            return '(%s)' % uids[0]
+        head = rnd.randint(1, len(uids) - 1)
+        chain = ' '.join(uids[:head])
+        rest = uids[head:]
+        if len(rest) == 1 or rnd.random() < 0.5:
+            return '(%s %s)' % (chain, ' '.join(rest))
+        split = rnd.randint(1, len(rest) - 1)
+        return '(%s %s%s)' % (
+            chain, thread(rest[:split]), thread(rest[split:])
+        )
+
+    uids = [str(i) for i in range(1, count + 1)]
+    result = []
+    pos = 0
+    while pos < count:
+        size = rnd.choice([1, 1, 1, 2, 3, 5, 10, 50])
+        result.append(thread(uids[pos:pos + size]))
+        pos += size
+    return ''.join(result)
+
+
+def parse_thread_old(line):
+    # the char by char parser which was used before
+    threads = []
+    all_uids = []
+    uids = []
+    uid = ''
+    opening = 0
+    for i in line:
+        if i == '(':
+            opening += 1
+        elif i == ')':
+            if uid:
+                uids.append(uid)
+                uid = ''
+
+            opening -= 1
+            if opening == 0:
+                threads.append(tuple(uids))
+                all_uids.extend(uids)
+                uids = []
+        elif i == ' ':
+            uids.append(uid)
+            uid = ''
+        else:
+            uid += i
+    return threads, all_uids
+
+
+def bench(name, fn, line):
+    start = time.perf_counter()
+    res = fn(line)
+    print('%-10s %8.3fs' % (name, time.perf_counter() - start))
+    return res
+
+
+def main(*counts):
+    for count in counts or (10000, 100000, 1000000):
+        line = response(count)
+        print('## %s uids, %s bytes' % (count, len(line)))
+        old, _ = bench('old', parse_thread_old, line)
+        new = bench('flat', imap.parse_thread, line)
+        bench('tree', lambda i: imap.parse_thread(i, tree=True), line)
+        assert list(new) == old
+
+
+if __name__ == '__main__':
+    main(*[int(i) for i in sys.argv[1:]])
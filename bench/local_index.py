@@ -0,0 +1,94 @@
+"""Benchmark for in-memory uid pairs and Message-IDs
+
+Usage:
+  python bench/local_index.py [<count>...]
+"""
+import json
+import pathlib
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from mailur import index  # noqa
+
+
+def pairs(count, seed=42):
+    rnd = random.Random(seed)
+    parsed = list(range(1, count + 1))
+    rnd.shuffle(parsed)
+    return {str(i): str(p) for i, p in zip(range(1, count + 1), parsed)}
+
+
+def msgids(count, seed=42):
+    rnd = random.Random(seed)
+    mids = {}
+    for i in range(1, count + 1):
+        mid = '<%x.%s@mail.example.com>' % (rnd.getrandbits(64), i % 1000)
+        if mids and rnd.random() < 0.05:
+            mid = rnd.choice(list(mids)) if i % 100 == 0 else mid
+        mids.setdefault(mid, []).append(str(i))
+    return mids
+
+
+def memory(fn):
+    tracemalloc.start()
+    res = fn()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del res
+    return size
+
+
+def bench(name, build, lookup):
+    size = memory(build)
+    start = time.perf_counter()
+    res = build()
+    built = time.perf_counter() - start
+    start = time.perf_counter()
+    found = lookup(res)
+    print('%-6s %8.1fMB build=%.3fs lookup=%.3fs' % (
+        name, size / 2 ** 20, built, time.perf_counter() - start
+    ))
+    return res, found
+
+
+def compare(old, new, lookup):
+    old, old_found = bench('dict', old, lookup)
+    new, new_found = bench('array', new, lookup)
+    assert old_found == new_found and new == old
+
+
+def main(*counts):
+    for count in counts or (10000, 100000, 1000000):
+        print('## %s uid pairs' % count)
+        raw = json.dumps(pairs(count))
+        keys = [str(i) for i in range(1, count + count // 10)]
+
+        def old():
+            origin = json.loads(raw)
+            return origin, {v: k for k, v in origin.items()}
+
+        def new():
+            origin = index.UidMap(json.loads(raw))
+            return origin, origin.inverse()
+
+        compare(old, new, lambda res: sum(
+            1 for i in keys if i in res[0] and res[1].get(res[0][i]) == i
+        ))
+
+        print('## %s msgids' % count)
+        data = msgids(count)
+        raw = json.dumps(data)
+        keys = list(data)[::2] + ['<%s@none>' % i for i in range(count // 2)]
+        compare(
+            lambda: json.loads(raw),
+            lambda: index.MidMap(json.loads(raw)),
+            lambda res: sum(1 for i in keys if res.get(i) is not None)
+        )
+
+
+if __name__ == '__main__':
+    main(*[int(i) for i in sys.argv[1:]])
@@ -1,17 +1,23 @@
 import functools as ft
 import hashlib
 import inspect
+import json
 import logging
 import logging.config
+import mmap
 import os
+import pickle
 import signal
+import stat
+import sys
 import time
 import uuid
+import weakref
+from collections import OrderedDict, namedtuple
 from contextlib import contextmanager
 
-from gevent import sleep
+from gevent import getcurrent, sleep
 
-cache = {}
 conf = {
     'DEBUG': os.environ.get('MLR_DEBUG', True),
     'DEBUG_IMAP': os.environ.get('MLR_DEBUG_IMAP', 0),
@@ -19,12 +25,48 @@ conf = {
     'SECRET': os.environ.get('MLR_SECRET', uuid.uuid4().hex),
     'MASTER': os.environ.get('MLR_MASTER', 'root:root').split(':'),
     'USER': os.environ.get('MLR_USER', 'user'),
+    'INDEX': os.environ.get('MLR_INDEX', 'metadata'),
+    'INDEX_PATH': os.environ.get('MLR_INDEX_PATH', '/home/vmail/index'),
+    'CACHE_SIZE': int(os.environ.get('MLR_CACHE_SIZE', 256 * 2 ** 20)),
+    'CACHE_USER_SIZE': int(
+        os.environ.get('MLR_CACHE_USER_SIZE', 64 * 2 ** 20)
+    ),
+    'CACHE_TTL': int(os.environ.get('MLR_CACHE_TTL', 3600)),
+    'CACHE_VERSION_TTL': float(os.environ.get('MLR_CACHE_VERSION_TTL', 1)),
+    'CACHE_PATH': os.environ.get('MLR_CACHE_PATH', ''),
+    'PARSE_BUFFER': int(os.environ.get('MLR_PARSE_BUFFER', 32 * 2 ** 20)),
+    'PARSE_CACHE': os.environ.get('MLR_PARSE_CACHE', ''),
+    'UNREAD_RECOUNT': int(os.environ.get('MLR_UNREAD_RECOUNT', 3600)),
 }
+users = weakref.WeakKeyDictionary()
+
+
+def get_user():
+    # User is bound to a greenlet and inherited by greenlets spawned
+    # from it, conf['USER'] is used outside of such greenlets
+    current = getcurrent()
+    parent = current
+    while parent is not None:
+        user = users.get(parent)
+        if user is not None:
+            if parent is not current:
+                users[current] = user
+            return user
+        parent = getattr(parent, 'spawning_greenlet', None)
+        parent = parent and parent()
+    return conf['USER']
+
+
+def set_user(user):
+    if user is None:
+        users.pop(getcurrent(), None)
+    else:
+        users[getcurrent()] = user
 
 
 class UserFilter(logging.Filter):
     def filter(self, record):
-        record.user = conf['USER']
+        record.user = get_user()
         return True
 
 
@@ -98,31 +140,248 @@ def fn_time(func, desc=None):
     return ft.wraps(func)(inner)
 
 
-def fn_cache(fn):
-    def get_cache():
-        cache = user_cache()
-        cache.setdefault(fn, {})
-        return cache[fn]
+def sizeof(obj, seen=None):
+    # rough deep size of cached value in bytes
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(sizeof(k, seen) + sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(sizeof(i, seen) for i in obj)
+    else:
+        for cls in type(obj).__mro__:
+            slots = getattr(cls, '__slots__', ())
+            for name in [slots] if isinstance(slots, str) else slots:
+                size += sizeof(getattr(obj, name, None), seen)
+        if hasattr(obj, '__dict__'):
+            size += sizeof(vars(obj), seen)
+    return size
+
+
+class Cache:
+    # LRU cache with TTL, limited by total size and by size per user.
+    # Entry can be bound to "version" (e.g. MODSEQ of mailbox), so it is
+    # recalculated when version is changed.
+    Entry = namedtuple('Entry', 'value size expires version checked')
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.counters = {}
+
+    def count(self, name, counter):
+        counters = self.counters.setdefault(name, {
+            'hits': 0, 'misses': 0, 'stale': 0, 'evictions': 0
+        })
+        counters[counter] += 1
+
+    def get(self, user, key, version=None):
+        entry = self.entries.get((user, key))
+        name = key[0].__name__
+        if entry is None:
+            self.count(name, 'misses')
+        elif entry.expires < time.time() or entry.version != version:
+            self.count(name, 'stale')
+            self.pop(user, key)
+            entry = None
+        else:
+            self.count(name, 'hits')
+            entry = entry._replace(checked=time.time())
+            self.entries[(user, key)] = entry
+            self.entries.move_to_end((user, key))
+        return entry
+
+    def recent(self, user, key):
+        # entry with version checked less than "CACHE_VERSION_TTL"
+        # seconds ago, it's used without getting the version again
+        entry = self.entries.get((user, key))
+        now = time.time()
+        if (
+            entry is None or entry.expires < now or
+            now - entry.checked >= conf['CACHE_VERSION_TTL']
+        ):
+            return None
+        self.count(key[0].__name__, 'hits')
+        self.entries.move_to_end((user, key))
+        return entry
+
+    def set(self, user, key, value, version=None):
+        self.pop(user, key)
+        size = sizeof(value)
+        if size > conf['CACHE_USER_SIZE']:
+            log.debug('## cache: %s is too big (%s bytes)', key[0], size)
+            return
+
+        now = time.time()
+        expires = now + conf['CACHE_TTL']
+        self.entries[(user, key)] = self.Entry(
+            value, size, expires, version, now
+        )
+        self.sizes[user] = self.sizes.get(user, 0) + size
+        self.evict(user)
+
+    def pop(self, user, key):
+        entry = self.entries.pop((user, key), None)
+        if entry is None:
+            return
+        self.sizes[user] -= entry.size
+        if not self.sizes[user]:
+            del self.sizes[user]
+
+    def evict(self, user):
+        for u, key in list(self.entries):
+            over_user = self.sizes.get(user, 0) > conf['CACHE_USER_SIZE']
+            over_all = self.size > conf['CACHE_SIZE']
+            if not over_user and not over_all:
+                break
+            if over_all or u == user:
+                self.count(key[0].__name__, 'evictions')
+                self.pop(u, key)
+
+    def clear(self, user=None, fn=None):
+        for u, key in list(self.entries):
+            if user not in (None, u) or fn not in (None, key[0]):
+                continue
+            self.pop(u, key)
+
+    @property
+    def size(self):
+        return sum(self.sizes.values())
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'entries': len(self.entries),
+            'users': dict(self.sizes),
+            'counters': {k: dict(v) for k, v in self.counters.items()},
+        }
+
+
+class Snapshots:
+    # Versioned snapshots of cached values in "CACHE_PATH" shared by all
+    # processes: a JSON line with version is followed by pickled value.
+    # Snapshots are unpickled, so only directories and files owned by
+    # current account and not writable by others are used.
+    def name(self, fn):
+        return '%s.%s' % (fn.__module__, fn.__qualname__)
+
+    def path(self, user, key):
+        name = self.name(key[0])
+        if any(key[1:]):
+            name += '-' + hashlib.md5(repr(key[1:]).encode()).hexdigest()[:8]
+        return os.path.join(conf['CACHE_PATH'], user, name)
+
+    def private(self, st):
+        return st.st_uid == os.getuid() and not st.st_mode & 0o022
+
+    def root(self, user):
+        # returns private directory for snapshots of "user" or None
+        if not conf['CACHE_PATH']:
+            return None
+        path = conf['CACHE_PATH']
+        for path in (path, os.path.join(path, user)):
+            os.makedirs(path, mode=0o700, exist_ok=True)
+            st = os.lstat(path)
+            if not stat.S_ISDIR(st.st_mode) or not self.private(st):
+                log.warn('## cache: %s is not private, skip snapshots', path)
+                return None
+        return path
+
+    def load(self, user, key, version):
+        try:
+            if not self.root(user):
+                return None
+            fd = os.open(self.path(user, key), os.O_RDONLY | os.O_NOFOLLOW)
+            with open(fd, 'rb') as f:
+                if not self.private(os.fstat(f.fileno())):
+                    log.warn('## cache: snapshot %s is not private', key[0])
+                    return None
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    pos = m.find(b'\n')
+                    if json.loads(m[:pos]) != json.loads(json.dumps(version)):
+                        return None
+                    with memoryview(m) as view, view[pos + 1:] as data:
+                        return pickle.loads(data)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            log.warn('## cache: snapshot %s is broken: %r', key[0], e)
+            return None
+
+    def dump(self, user, key, value, version):
+        if not conf['CACHE_PATH']:
+            return
+        path = self.path(user, key)
+        tmp = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+        try:
+            if not self.root(user):
+                return
+            flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+            with open(os.open(tmp, flags, 0o600), 'wb') as f:
+                f.write(json.dumps(version).encode() + b'\n')
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        except Exception as e:
+            log.warn('## cache: snapshot %s is not saved: %r', key[0], e)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def clear(self, user, fn):
+        if not conf['CACHE_PATH']:
+            return
+        path, name = os.path.split(self.path(user, (fn,)))
+        if not os.path.isdir(path):
+            return
+        for i in os.listdir(path):
+            if i == name or i.startswith(name + '-'):
+                try:
+                    os.remove(os.path.join(path, i))
+                except FileNotFoundError:
+                    pass
+
+
+cache = Cache()
+snapshots = Snapshots()
+
+
+def fn_cache(fn=None, *, version=None, shared=False):
+    # "version" is called with the same arguments as "fn"; "shared" values
+    # are also saved as snapshots for other processes, only versioned
+    # values can be shared
+    if fn is None:
+        return ft.partial(fn_cache, version=version, shared=shared)
+    shared = shared and version is not None
 
     @ft.wraps(fn)
     def inner(*a, **kw):
-        cache = get_cache()
-        key = a, tuple((k, kw[k]) for k in sorted(kw))
-        if key not in cache:
+        user = get_user()
+        key = fn, a, tuple((k, kw[k]) for k in sorted(kw))
+        entry = cache.recent(user, key) if version else None
+        if entry is not None:
+            return entry.value
+        current = version(*a, **kw) if version else None
+        entry = cache.get(user, key, current)
+        if entry is not None:
+            return entry.value
+        res = snapshots.load(user, key, current) if shared else None
+        if res is None:
             res = fn(*a, **kw)
-            cache[key] = res
-        return cache[key]
-
-    inner.cache_clear = lambda: get_cache().clear()
-    return inner
+            if shared:
+                snapshots.dump(user, key, res, current)
+        cache.set(user, key, res, current)
+        return res
 
+    def cache_clear():
+        cache.clear(get_user(), fn)
+        if shared:
+            snapshots.clear(get_user(), fn)
 
-def user_cache():
-    global cache
-
-    user = conf['USER']
-    cache.setdefault(user, {})
-    return cache[user]
+    inner.cache_clear = cache_clear
+    return inner
 
 
 class LockError(Exception):
@@ -147,8 +406,9 @@ def global_lock(target, timeout=180, wait=3, force=False):
             os.remove(path)
             return
 
+        # without "timeout" a holder is never killed
         elapsed = time.time() - os.path.getctime(path)
-        if elapsed > timeout or force:
+        if force or timeout is not None and elapsed > timeout:
             try:
                 os.kill(int(pid), signal.SIGQUIT)
                 os.remove(path)
@@ -181,6 +441,6 @@ def global_lock(target, timeout=180, wait=3, force=False):
 
 @contextmanager
 def user_lock(target, **opts):
-    target = '%s:%s' % (conf['USER'], target)
+    target = '%s:%s' % (get_user(), target)
     with global_lock(target, **opts):
         yield
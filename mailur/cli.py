@@ -4,9 +4,10 @@ Usage:
   mlr gmail <login> set <username> <password>
   mlr gmail <login> [--tag=<tag> --box=<box> --parse] [options]
   mlr parse <login> [<criteria>] [options]
+  mlr reparse <login> [options]
   mlr threads <login> [<criteria>]
   mlr sync <login> [--timeout=<timeout>]
-  mlr sync-flags <login> [--reverse]
+  mlr sync-flags <login> [--reverse] [--full]
   mlr clean-flags <login>
   mlr update-links <login>
   mlr update-metadata <login>
@@ -20,6 +21,8 @@ Usage:
 Options:
   -b <batch>    Batch size [default: 1000].
   -t <threads>  Amount of threads for thread pool [default: 2].
+  --fixed       Keep batch size and threads, don't tune them while running.
+  --procs=<procs>  Amount of processes for parsing [default: 0].
 """
 import functools as ft
 import pathlib
@@ -49,6 +52,7 @@ def process(args):
     opts = {
         'batch': int(args.get('-b')),
         'threads': int(args.get('-t')),
+        'tune': not args.get('--fixed'),
     }
     if args['gmail'] and args['set']:
         gmail.save_credentials(args['<username>'], args['<password>'])
@@ -59,16 +63,18 @@ def process(args):
 
         gmail.fetch(**fetch_opts)
         if args['--parse']:
-            local.parse(**opts)
+            local.parse(procs=int(args['--procs']), **opts)
     elif args['parse']:
-        local.parse(args.get('<criteria>'), **opts)
+        local.parse(args.get('<criteria>'), int(args['--procs']), **opts)
+    elif args['reparse']:
+        local.reparse(int(args['--procs']), **opts)
     elif args['sync']:
         sync(int(args['--timeout']))
     elif args['sync-flags']:
         if args['--reverse']:
-            local.sync_flags_to_src()
+            local.sync_flags_to_src(full=args['--full'])
         else:
-            local.sync_flags_to_all()
+            local.sync_flags_to_all(full=args['--full'])
     elif args['clean-flags']:
         local.clean_flags()
     elif args['update-links']:
@@ -77,6 +83,7 @@ def process(args):
         local.save_addrs()
         local.save_msgids()
         local.save_uid_pairs()
+        local.update_unread(full=True)
     elif args['threads']:
         with local.client() as con:
             local.update_threads(con, criteria=args.get('<criteria>'))
@@ -127,11 +134,16 @@ def sync(timeout=1200):
 
     @retry
     def flags():
-        local.sync_flags_to_all()
         local.sync_flags(timeout=timeout)
 
+    @retry
+    def unread():
+        # counters are kept by flag changes, but recounted from time to time
+        local.update_unread(full=True)
+        sleep(conf['UNREAD_RECOUNT'])
+
     try:
-        jobs = [spawn(remote), spawn(flags)]
+        jobs = [spawn(remote), spawn(flags), spawn(unread)]
         joinall(jobs, raise_error=True)
     except KeyboardInterrupt:
         time.sleep(1)
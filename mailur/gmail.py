@@ -81,30 +81,21 @@ def get_credentials():
 def fetch_uids(uids, tag, box):
     exists = {}
     with local.client(local.SRC) as con:
-        res = con.fetch('1:*', 'BODY.PEEK[HEADER.FIELDS (X-GM-MSGID)]')
-        for i in range(0, len(res), 2):
-            uid = res[i][0].decode().split()[2]
-            line = res[i][1].strip()
+        res = con.fetch_iter('1:*', 'BODY.PEEK[HEADER.FIELDS (X-GM-MSGID)]')
+        for msg in res:
+            line = msg.body.strip()
             if not line:
                 continue
             gid = email.message_from_bytes(line)['X-GM-MSGID'].strip()
-            exists[gid.strip('<>')] = uid
+            exists[gid.strip('<>')] = msg.uid
 
     new_uids = []
     with client(tag, box=box) as gm:
         res = gm.fetch(uids.str, 'X-GM-MSGID')
-        for line in res:
-            parts = re.search(
-                r'('
-                r'UID (?P<uid>\d+)'
-                r' ?|'
-                r'X-GM-MSGID (?P<msgid>\d+)'
-                r' ?){2}',
-                line.decode()
-            ).groupdict()
-            if parts['msgid'] in exists:
+        for msg in imap.parse_fetch(res):
+            if msg.attrs['X-GM-MSGID'] in exists:
                 continue
-            new_uids.append(parts['uid'])
+            new_uids.append(msg.uid)
         if not new_uids:
             log.debug('## %s are alredy imported' % uids)
             return
@@ -117,47 +108,27 @@ def fetch_uids(uids, tag, box):
         res = gm.fetch(new_uids, fields)
         login = gm.username
 
-    def flag(m):
-        flag = m.group()
-        if flag:
-            return MAP_FLAGS.get(flag, '')
-        return ''
-
-    def label(m):
-        label = m.group()
-        if label:
-            label = label.strip('"').replace('\\\\', '\\')
-            label = imap_utf7.decode(label)
-            flag = MAP_LABELS.get(label, None)
-            return local.get_tag(label)['id'] if flag is None else flag
-        return ''
+    def flag(flag):
+        return MAP_FLAGS.get(flag, '')
+
+    def label(label):
+        if isinstance(label, list):
+            label = '(%s)' % ' '.join(label)
+        label = imap_utf7.decode(label)
+        flag = MAP_LABELS.get(label, None)
+        return local.get_tag(label)['id'] if flag is None else flag
 
     def msgs():
-        for i in range(0, len(res), 2):
-            line, raw = res[i]
-            parts = re.search(
-                r'('
-                r'UID (?P<uid>\d+)'
-                r' ?|'
-                r'INTERNALDATE (?P<time>"[^"]+")'
-                r' ?|'
-                r'FLAGS \((?P<flags>[^)]*)\)'
-                r' ?|'
-                r'X-GM-LABELS \((?P<labels>.*)\)'
-                r' ?|'
-                r'X-GM-MSGID (?P<msgid>\d+)'
-                r' ?|'
-                r'X-GM-THRID (?P<thrid>\d+)'
-                r' ?){6}',
-                line.decode()
-            ).groupdict()
-            if not raw or parts['msgid'] in exists:
+        for msg in imap.parse_fetch(res):
+            raw = msg.parts.get('BODY[]')
+            msgid = msg.attrs['X-GM-MSGID']
+            if not raw or msgid in exists:
                 # this happens in "[Gmail]/Chats" folder
                 continue
-            flags = re.sub(r'([^ ])*', flag, parts['flags'])
+            flags = ' '.join(flag(f) for f in msg.flags)
             flags = ' '.join([
                 flags,
-                re.sub(r'("[^"]*"|[^" ]*)', label, parts['labels']),
+                ' '.join(label(i) for i in msg.attrs['X-GM-LABELS']),
                 MAP_LABELS.get(tag, ''),
             ]).strip()
             if SKIP_DRAFTS and '\\Draft' in flags:
@@ -166,9 +137,9 @@ def fetch_uids(uids, tag, box):
 
             headers = [
                 'X-SHA256: <%s>' % hashlib.sha256(raw).hexdigest(),
-                'X-GM-UID: <%s>' % parts['uid'],
-                'X-GM-MSGID: <%s>' % parts['msgid'],
-                'X-GM-THRID: <%s>' % parts['thrid'],
+                'X-GM-UID: <%s>' % msg.uid,
+                'X-GM-MSGID: <%s>' % msgid,
+                'X-GM-THRID: <%s>' % msg.attrs['X-GM-THRID'],
                 'X-GM-Login: <%s>' % login,
             ]
             thrid_re = r'(^| )mlr/thrid/\d+'
@@ -183,7 +154,7 @@ def fetch_uids(uids, tag, box):
             headers = '\r\n'.join(headers)
 
             raw = headers.encode() + raw
-            yield parts['time'], flags, raw
+            yield msg.time, flags, raw
 
     msgs = list(msgs())
     if not msgs:
@@ -223,8 +194,10 @@ def fetch_folder(tag='\\All', *, box=None, **opts):
     gm.logout()
     if len(uids):
         uids = imap.Uids(uids, **opts)
-        uids.call_async(fetch_uids, uids, tag, box)
-        local.save_msgids()
+        res = uids.call_async(fetch_uids, uids, tag, box)
+        new_uids = ','.join(i for i in res if i)
+        if new_uids:
+            local.save_msgids(new_uids)
 
     with local.client(None) as lm:
         lm.setmetadata(local.SRC, metakey, '%s,%s' % (uidvalidity, uidnext))
@@ -1,12 +1,16 @@
 import functools as ft
+import gc
 import inspect
+import itertools as it
 import json
 import re
 import time
-from contextlib import contextmanager
-from imaplib import CRLF, Time2Internaldate
+import weakref
+from array import array
+from contextlib import closing, contextmanager
+from imaplib import CRLF, MapCRLF, Time2Internaldate
 
-from gevent import Timeout
+from gevent import Timeout, sleep, spawn, wait
 from gevent.lock import RLock
 from gevent.pool import Pool
 
@@ -99,7 +103,9 @@ def command(*, name=None, lock=True, writable=False, dovecot=False):
 class Conn:
     def defaults(self):
         self.current_box = None
+        self.uidvalidity = None
         self.flags = None
+        self.reusable = True
 
     def __repr__(self):
         return str(self)
@@ -113,6 +119,7 @@ class Conn:
 class Ctx:
     def __init__(self, con):
         self._con = con
+        self._pool = None
 
     def __repr__(self):
         return str(self)
@@ -136,9 +143,141 @@ class Ctx:
         return self
 
     def __exit__(self, *args):
+        if self._pool:
+            self._pool.release(self, args[0])
+            return
         self.logout()
 
 
+class ConnPool:
+    def __init__(self, create, *, size=5, keepalive=60, max_idle=300):
+        self.create = create
+        self.size = size
+        self.keepalive = keepalive
+        self.max_idle = max_idle
+        self.free = []
+        self.used = weakref.WeakSet()
+        self.watcher = None
+
+    def __repr__(self):
+        return str(self)
+
+    def __str__(self):
+        return '%s{%s free}' % (self.__class__.__name__, len(self.free))
+
+    def get(self, box=None, readonly=True):
+        while self.free:
+            ctx = self.pop(box, readonly)
+            try:
+                self.prepare(ctx, box, readonly)
+            except (Exception, Timeout) as e:
+                log.debug('## %s: drop %s: %r', self, ctx, e)
+                self.discard(ctx)
+                continue
+            self.used.add(ctx)
+            return ctx
+
+        ctx = self.create()
+        ctx._pool = self
+        if box:
+            try:
+                ctx.select(box, readonly)
+            except BaseException:
+                self.discard(ctx)
+                raise
+        self.used.add(ctx)
+        return ctx
+
+    def pop(self, box, readonly):
+        def rank(ctx):
+            con = ctx._con
+            return (
+                con.current_box == box,
+                con.current_box == box and con.is_readonly == readonly
+            )
+
+        ctx = max(reversed(self.free), key=rank)
+        self.free.remove(ctx)
+        return ctx
+
+    def prepare(self, ctx, box, readonly):
+        con = ctx._con
+        if box and (con.current_box != box or con.is_readonly != readonly):
+            ctx.select(box, readonly)
+        elif box:
+            # the box can be renamed or deleted by another process (e.g.
+            # by reparse), then a new one with the same name is selected
+            res = ctx.status(box, '(UIDVALIDITY)')
+            uidvalidity = re.search(r'UIDVALIDITY (\d+)', res[0].decode())
+            if int(uidvalidity.group(1)) != con.uidvalidity:
+                ctx.select(box, readonly)
+            else:
+                update_flags(con)
+        else:
+            # health check and a chance to get fresh FLAGS for selected box
+            ctx.noop()
+        con.untagged_responses.clear()
+
+    def release(self, ctx, error=None):
+        self.used.discard(ctx)
+        con = ctx._con
+        reuse = (
+            not error and con.reusable and
+            con.state in ('AUTH', 'SELECTED') and
+            len(self.free) < self.size
+        )
+        if not reuse:
+            self.discard(ctx)
+            return
+
+        ctx._released = time.time()
+        self.free.append(ctx)
+        if self.watcher is None or self.watcher.dead:
+            self.watcher = spawn(self.watch)
+
+    def discard(self, ctx):
+        if ctx._con.state == 'LOGOUT':
+            return
+        try:
+            ctx.logout()
+        except (Exception, Timeout) as e:
+            log.debug('## %s: logout %s: %r', self, ctx, e)
+
+    def watch(self):
+        while self.free:
+            sleep(self.keepalive)
+            for ctx in list(self.free):
+                idle = time.time() - ctx._released
+                if ctx not in self.free or idle < self.keepalive:
+                    continue
+
+                self.free.remove(ctx)
+                if idle > self.max_idle:
+                    self.discard(ctx)
+                    continue
+                try:
+                    ctx.noop()
+                except (Exception, Timeout) as e:
+                    log.debug('## %s: drop %s: %r', self, ctx, e)
+                    self.discard(ctx)
+                    continue
+                self.free.append(ctx)
+
+    def drop(self, *boxes):
+        # connections with renamed or deleted box selected still point to
+        # the old mailbox: free ones are discarded, used ones aren't reused
+        for ctx in list(self.used):
+            if ctx._con.current_box in boxes:
+                ctx._con.reusable = False
+        for ctx in [i for i in self.free if i._con.current_box in boxes]:
+            self.free.remove(ctx)
+            self.discard(ctx)
+
+    def clear(self):
+        while self.free:
+            self.discard(self.free.pop())
+
+
 def client(connect, *, writable=False, dovecot=False, debug=None):
     def start():
         con = connect()
@@ -194,34 +333,54 @@ def _mdkey(key):
 def setmetadata(con, box, key, value):
     key = _mdkey(key)
     with _cmd(con, 'SETMETADATA') as (tag, start, complete):
-        args = ' %s (%s %s)' % (box, key, json.dumps(value))
-        start(args.encode() + CRLF)
+        if 'LITERAL+' in con.capabilities:
+            # a quoted value is limited by the length of command line
+            value = value.encode()
+            args = ' %s (%s {%s+}' % (box, key, len(value))
+            start(args.encode() + CRLF + value + b')' + CRLF)
+        else:
+            args = ' %s (%s %s)' % (box, key, json.dumps(value))
+            start(args.encode() + CRLF)
         typ, data = complete()
         return check(con._untagged_response(typ, data, 'METADATA'))
 
 
 @command(dovecot=True)
-def getmetadata(con, box, key):
-    key = _mdkey(key)
+def getmetadata(con, box, *keys, depth=None):
+    keys = ' '.join(_mdkey(k) for k in keys)
+    opts = '(DEPTH %s) ' % depth if depth else ''
     with _cmd(con, 'GETMETADATA') as (tag, start, complete):
-        args = ' %s (%s)' % (box, key)
+        args = ' %s%s (%s)' % (opts, box, keys)
         start(args.encode() + CRLF)
         typ, data = complete()
         return check(con._untagged_response(typ, data, 'METADATA'))
 
 
+def parse_metadata(res):
+    # Values are literals, missing keys are skipped
+    data = {}
+    for i in res:
+        if not isinstance(i, tuple):
+            continue
+        key = re.search(rb'(\S+) \{\d+\}$', i[0]).group(1).decode()
+        data[re.sub('^/private/', '', key)] = i[1]
+    return data
+
+
 def _multiappend(con, box, msgs):
+    # with LITERAL+ all literals are sent without waiting for continuation
+    literal = '{%s+}' if 'LITERAL+' in con.capabilities else '{%s}'
     with _cmd(con, 'APPEND') as (tag, start, complete):
         send = start
         for date_time, flags, msg in msgs:
             if date_time is None:
                 date_time = Time2Internaldate(time.time())
-            args = (' (%s) %s %s' % (flags, date_time, '{%s}' % len(msg)))
+            args = (' (%s) %s %s' % (flags, date_time, literal % len(msg)))
             if send == start:
                 args = ' %s %s' % (box, args)
             send(args.encode() + CRLF)
             send = con.send
-            while con._get_response():
+            while literal == '{%s}' and con._get_response():
                 bad = con.tagged_commands[tag]
                 if bad:
                     raise Error(bad)
@@ -236,6 +395,8 @@ def _multiappend(con, box, msgs):
 
 @command(dovecot=True, writable=True, lock=False)
 def multiappend(con, box, msgs, *, batch=None, threads=10):
+    # APPEND isn't idempotent, so it's never retried (unlike Tune.run
+    # does for FETCH, STORE and SEARCH batches)
     if not msgs:
         return
 
@@ -259,16 +420,30 @@ def multiappend(con, box, msgs, *, batch=None, threads=10):
 
 
 @command(dovecot=True)
-def thread(con, *criteria):
+def thread(con, *criteria, tree=False):
     res = check(con.uid('THREAD', *criteria))
-    return parse_thread(res[0].decode())
+    return parse_thread(res[0], tree=tree)
 
 
 @command(dovecot=True)
-def sort(con, fields, *criteria, charset='UTF-8'):
+def sort(con, fields, *criteria, charset='UTF-8', ret=None):
+    if ret:
+        return _esearch(con, 'SORT', ret, fields, charset, *criteria)
     return check(con.uid('SORT', fields, charset, *criteria))
 
 
+def _esearch(con, name, ret, *criteria):
+    # "ret" is RETURN options like "PARTIAL 1:100 COUNT", then the result
+    # is a parsed ESEARCH response
+    criteria = ' '.join(i for i in criteria if i)
+    with _cmd(con, 'UID') as (tag, start, complete):
+        args = ' %s RETURN (%s) %s' % (name, ret, criteria)
+        start(args.encode() + CRLF)
+        typ, data = complete()
+        res = check(con._untagged_response(typ, data, 'ESEARCH'))
+    return parse_esearch(res[-1])
+
+
 @command()
 def idle(con, handler, code='EXISTS', timeout=None):
     def match():
@@ -288,6 +463,8 @@ def idle(con, handler, code='EXISTS', timeout=None):
 
     match()
     log.info('## start idling %s...' % con)
+    # IDLE can be interrupted by timeout without DONE
+    con.reusable = False
     with _cmd(con, 'IDLE') as (tag, start, complete):
         start(CRLF)
         while 1:
@@ -307,6 +484,19 @@ def logout(con, timeout=1):
         return con.logout()
 
 
+def update_flags(con):
+    flags = con.untagged_responses.get('FLAGS')
+    if flags and con.current_box:
+        con.flags = flags[-1].decode()[1:-1].split()
+
+
+@command()
+def noop(con):
+    res = check(con.noop())
+    update_flags(con)
+    return res
+
+
 @command(name='list')
 def xlist(con, folder='""', pattern='*'):
     return check(con.list(folder, pattern))
@@ -316,6 +506,7 @@ def xlist(con, folder='""', pattern='*'):
 def select(con, box, readonly=True):
     res = check(con.select(box, readonly))
     con.current_box = box.decode() if isinstance(box, bytes) else box
+    con.uidvalidity = int(con.untagged_responses['UIDVALIDITY'][0])
     con.flags = con.untagged_responses['FLAGS'][0].decode()[1:-1].split()
     return res
 
@@ -342,15 +533,39 @@ def status(con, box, fields):
     return check(con.status(box, fields))
 
 
+@command(dovecot=True, writable=True)
+def create(con, box):
+    return check(con.create(box))
+
+
+@command(dovecot=True, writable=True)
+def rename(con, box, new_box):
+    return check(con.rename(box, new_box))
+
+
+@command(dovecot=True, writable=True)
+def delete(con, box):
+    return check(con.delete(box))
+
+
 @command()
-def search(con, *criteria):
+def search(con, *criteria, ret=None):
+    if ret:
+        return _esearch(con, 'SEARCH', ret, *criteria)
     return check(con.uid('SEARCH', None, *criteria))
 
 
 @command(writable=True)
 def append(con, box, flags, date_time, msg):
-    res = check(con.append(box, flags, date_time, msg))
-    return re.search(r'\[APPENDUID \d+ (\d+)\]', res[0].decode()).group(1)
+    if 'LITERAL+' not in con.capabilities:
+        res = check(con.append(box, flags, date_time, msg))
+        return re.search(r'\[APPENDUID \d+ (\d+)\]', res[0].decode()).group(1)
+
+    if date_time is not None:
+        date_time = Time2Internaldate(date_time)
+    flags = (flags or '').strip('()')
+    msg = MapCRLF.sub(CRLF, msg)
+    return _multiappend(con, box, [(date_time, flags, msg)])
 
 
 @command(writable=True)
@@ -363,8 +578,9 @@ def expunge(con):
 def fetch(con, uids, fields):
     uids = Uids(uids)
     if uids.batches:
-        res = uids.call_async(fetch, con, uids, fields)
-        return sum(res, [])
+        return _pipeline_batches(
+            con, uids, lambda few: 'UID FETCH %s %s' % (few.str, fields)
+        )
 
     desc = fn_desc(fetch, con, uids, fields)
     with con.lock:
@@ -374,6 +590,96 @@ def fetch(con, uids, fields):
     return res
 
 
+@command(lock=False)
+def fetch_iter(con, uids, fields):
+    # Yields Fetched records while the response is read, the connection
+    # is locked until the generator is exhausted, so don't use it inside
+    if not uids:
+        return
+
+    uids = Uids(uids)
+    desc = fn_desc(fetch_iter, con, uids, fields)
+    yield from fn_time(_fetch_iter, desc)(con, uids, fields)
+
+
+def _fetch_iter(con, uids, fields):
+    cmds = [
+        'UID FETCH %s %s' % (few.str, fields)
+        for few in uids.batches or [uids]
+    ]
+    with con.lock, closing(_pipelined(con, cmds)) as responses:
+        try:
+            for num, res in responses:
+                if num is None:
+                    yield Fetched(res)
+                else:
+                    check(res)
+        except con.error as e:
+            raise Error(e)
+
+
+def _pipelined(con, cmds):
+    # Commands are written by a separate greenlet while responses are read,
+    # so a server can work on the next command without waiting for a client.
+    # Yields (None, items) for FETCH/SEARCH/SORT/THREAD untagged responses
+    # and (index of command, (typ, data)) for tagged ones. Dovecot sends all
+    # untagged responses of a command before its tagged one and doesn't mix
+    # them with responses of other commands.
+    tags = [con._new_tag() for i in cmds]
+
+    def write():
+        for tag, cmd in zip(tags, cmds):
+            con.send(b'%s %s%s' % (tag, cmd.encode(), CRLF))
+
+    writer = spawn(write)
+    pending = dict(zip(tags, range(len(tags))))
+
+    def read():
+        con._get_response()
+        for name in ('FETCH', 'SEARCH', 'SORT', 'THREAD'):
+            items = con.untagged_responses.pop(name, None)
+            if items:
+                yield None, items
+        for tag in [i for i in pending if con.tagged_commands[i]]:
+            yield pending.pop(tag), con.tagged_commands.pop(tag)
+
+    try:
+        while pending:
+            yield from read()
+    except GeneratorExit:
+        # read the rest of responses to keep the connection usable
+        writer.join()
+        while pending:
+            for i in read():
+                pass
+        raise
+    except BaseException:
+        writer.kill()
+        raise
+    writer.get()
+
+
+@command()
+def pipeline(con, cmds):
+    # Returns (typ, data) for every command like imaplib does
+    results = [None] * len(cmds)
+    data = []
+    for num, res in _pipelined(con, cmds):
+        if num is None:
+            data.extend(res)
+            continue
+        typ, dat = res
+        results[num] = (typ, (data or [None]) if typ == 'OK' else dat)
+        data = []
+    return results
+
+
+def _pipeline_batches(con, uids, cmd):
+    cmds = [cmd(few) for few in uids.batches]
+    res = fn_time(pipeline, fn_desc(pipeline, con, uids))(con, cmds)
+    return [i for r in res for i in check(r) if i is not None]
+
+
 @command(lock=False, writable=True)
 @cmd_writable
 def store(con, uids, cmd, flags):
@@ -382,8 +688,9 @@ def store(con, uids, cmd, flags):
 
     uids = Uids(uids)
     if uids.batches:
-        res = uids.call_async(store, con, uids, cmd, flags)
-        return sum(res, [])
+        return _pipeline_batches(
+            con, uids, lambda few: 'UID STORE %s %s %s' % (few.str, cmd, flags)
+        )
 
     desc = fn_desc(store, con, uids, cmd, flags)
     with con.lock:
@@ -393,85 +700,381 @@ def store(con, uids, cmd, flags):
     return res
 
 
+fetch_re = re.compile(
+    r'[()]|"(?:[^"\\]|\\.)*"|[^\s()"\[]+(?:\[[^\]]*\](?:<\d+>)?)?'
+)
+fetch_section_re = re.compile(r'\[[^\]]* ')
+
+
+def tokenize_fetch(line):
+    # Quoted strings are returned with the leading quote only
+    if '\\"' in line or '[' in line and fetch_section_re.search(line):
+        return [
+            i[:-1] if i.startswith('"') else i
+            for i in fetch_re.findall(line)
+        ]
+
+    if '"' not in line:
+        return line.replace('(', ' ( ').replace(')', ' ) ').split()
+
+    tokens = []
+    for num, i in enumerate(line.split('"')):
+        if num % 2:
+            tokens.append('"' + i)
+        else:
+            tokens.extend(i.replace('(', ' ( ').replace(')', ' ) ').split())
+    return tokens
+
+
+def fetch_value(value, tokens, literals):
+    if value == '(':
+        value = []
+        for i in tokens:
+            if i == ')':
+                break
+            elif i == '(' or i[0] in '"{~':
+                i = fetch_value(i, tokens, literals)
+            value.append(i)
+    elif value[0] == '"':
+        value = value[1:]
+        if '\\' in value:
+            value = re.sub(r'\\(.)', r'\1', value)
+    elif value[0] in '{~' and value[-1] == '}':
+        # "~{n}" is literal8 (RFC 3516), Dovecot sends it for BINARY[]
+        value = next(literals)
+    elif value == 'NIL':
+        value = None
+    return value
+
+
+class Fetched:
+    __slots__ = ['uid', 'flags', 'time', 'modseq', 'parts', 'attrs']
+
+    def __init__(self, items):
+        if len(items) == 1:
+            line = items[0].decode()
+            literals = ()
+        elif len(items) == 2 and items[1] == b')':
+            line = items[0][0].decode() + ')'
+            literals = (items[0][1],)
+        else:
+            line = []
+            literals = []
+            for i in items:
+                if isinstance(i, tuple):
+                    literals.append(i[1])
+                    i = i[0]
+                line.append(i.decode())
+            line = ''.join(line)
+
+        self.uid = self.flags = self.time = self.modseq = None
+        parts = self.parts = {}
+        attrs = self.attrs = {}
+        literals = iter(literals)
+        tokens = iter(tokenize_fetch(line))
+        next(tokens)  # message sequence number
+        next(tokens)  # opening parenthesis
+        for key in tokens:
+            if key == ')':
+                break
+            value = next(tokens)
+            if value[0] in '("{~N':
+                value = fetch_value(value, tokens, literals)
+            if key == 'UID':
+                self.uid = value
+            elif key == 'FLAGS':
+                self.flags = value
+            elif key == 'MODSEQ':
+                self.modseq = value[0]
+            elif key == 'INTERNALDATE':
+                self.time = '"%s"' % value
+            elif '[' in key:
+                if isinstance(value, str):
+                    value = value.encode()
+                parts[key.upper()] = value
+            else:
+                attrs[key.upper()] = value
+
+    @property
+    def body(self):
+        return next(iter(self.parts.values()), None)
+
+    def __repr__(self):
+        return str(self)
+
+    def __str__(self):
+        return 'Fetched{%r, %r, %r}' % (self.uid, self.flags, list(self.parts))
+
+
+def parse_fetch(res):
+    items = []
+    for i in res:
+        items.append(i)
+        if not isinstance(i, tuple):
+            yield Fetched(items)
+            items = []
+
+
 class Threads(tuple):
-    def __new__(cls, thrs, uids):
+    def __new__(cls, thrs, uids, tree=None):
         obj = tuple.__new__(cls, thrs)
         obj.all_uids = uids
+        obj.tree = tree
         return obj
 
 
-def parse_thread(line):
+def parse_thread(line, tree=False):
+    # With "tree" each node is (uid, children), uid is None for
+    # a missing parent, "Threads.tree" contains root nodes
     if isinstance(line, bytes):
         line = line.decode()
 
+    if tree and gc.isenabled():
+        # no reference cycles here, but collector slows down
+        # building of millions nodes a lot
+        gc.disable()
+        try:
+            return parse_thread(line, tree)
+        finally:
+            gc.enable()
+
     threads = []
     all_uids = []
     uids = []
-    uid = ''
-    opening = 0
-    for i in line:
+    depth = 0
+    roots = []
+    stack = []
+    for i in line.replace('(', ' ( ').replace(')', ' ) ').split():
         if i == '(':
-            opening += 1
+            depth += 1
+            if not tree:
+                continue
+            elif not stack:
+                parent = (None, roots)
+            else:
+                parent, tail = stack[-1]
+                if tail is None:
+                    tail = (None, [])
+                    parent[1].append(tail)
+                    stack[-1][1] = tail
+                parent = tail
+            stack.append([parent, None])
         elif i == ')':
-            if uid:
-                uids.append(uid)
-                uid = ''
-
-            opening -= 1
-            if opening == 0:
+            depth -= 1
+            if tree:
+                stack.pop()
+            if not depth:
                 threads.append(tuple(uids))
                 all_uids.extend(uids)
                 uids = []
-        elif i == ' ':
-            uids.append(uid)
-            uid = ''
         else:
-            uid += i
-    return Threads(threads, all_uids)
+            uids.append(i)
+            if tree:
+                frame = stack[-1]
+                node = (i, [])
+                (frame[1] or frame[0])[1].append(node)
+                frame[1] = node
+    return Threads(threads, all_uids, roots if tree else None)
 
 
 def pack_uids(uids):
-    uids = sorted(int(i) for i in uids)
-    result = ''
-    for i, uid in enumerate(uids):
-        if i == 0:
-            result += str(uid)
-        elif uid - uids[i-1] == 1:
-            if len(uids) == (i + 1):
-                if not result.endswith(':'):
-                    result += ':'
-                result += str(uid)
-            elif result.endswith(':'):
-                pass
-            else:
-                result += ':'
-        elif result.endswith(':'):
-            result += '%d,%d' % (uids[i-1], uid)
-        else:
-            result += ',%s' % uid
+    uids = sorted(set(int(i) for i in uids))
+    if not uids:
+        return ''
+
+    ranges = []
+    first = last = uids[0]
+    for uid in it.islice(uids, 1, None):
+        if uid != last + 1:
+            ranges.append((first, last))
+            first = uid
+        last = uid
+    ranges.append((first, last))
+    return ','.join(
+        str(a) if a == b else '%d:%d' % (a, b) for a, b in ranges
+    )
+
+
+def unpack_uids(uids):
+    # keeps order, ESORT returns sequence sets in sort order
+    result = []
+    for i in uids.split(','):
+        if ':' not in i:
+            result.append(i)
+            continue
+        first, last = (int(j) for j in i.split(':'))
+        step = 1 if first <= last else -1
+        result.extend(str(j) for j in range(first, last + step, step))
     return result
 
 
+def parse_esearch(line):
+    # Returns dict like {'count': 10, 'partial': ['3', '1']}, uids are
+    # unpacked for "all" and "partial", "min", "max" are single uids
+    if not line:
+        return {}
+    if isinstance(line, bytes):
+        line = line.decode()
+
+    line = re.sub(r'^\(TAG "[^"]*"\) ?', '', line)
+    tokens = re.findall(r'\([^)]*\)|\S+', line)
+    res = {}
+    items = iter(tokens)
+    for key in items:
+        key = key.lower()
+        if key == 'uid':
+            continue
+        value = next(items)
+        if key == 'partial':
+            value = value[1:-1].split()[1]
+            value = [] if value == 'NIL' else unpack_uids(value)
+        elif key == 'all':
+            value = unpack_uids(value)
+        elif key in ('count', 'modseq'):
+            value = int(value)
+        res[key] = value
+    return res
+
+
+class Tune:
+    # AIMD: threads grow by one while time per item stays close to the best
+    # one and halve on slowdown or error; batch grows while a batch takes
+    # less than half of "latency" and halves when it takes longer
+    def __init__(self, batch=1000, threads=2, *, latency=10, retries=2):
+        self.batch = batch
+        self.threads = threads
+        self.latency = latency
+        self.retries = retries
+        self.step = max(1, batch // 2)
+        self.min_batch = max(1, batch // 100)
+        self.max_batch = batch * 10
+        self.max_threads = max(10, threads * 5)
+        self.best = None
+
+    def success(self, count, duration):
+        item = duration / max(count, 1)
+        if self.best is None or item < self.best:
+            self.best = item
+
+        threads, batch = self.threads, self.batch
+        # quick batches are too noisy to judge a slowdown
+        if item > self.best * 2 and duration > self.latency / 10:
+            threads = max(1, threads // 2)
+        else:
+            threads = min(self.max_threads, threads + 1)
+        if duration > self.latency:
+            batch = max(self.min_batch, batch // 2)
+        elif duration < self.latency / 2:
+            batch = min(self.max_batch, batch + self.step)
+        self.update(threads, batch, '%s items for %.2fs' % (count, duration))
+
+    def failure(self, error):
+        threads = max(1, self.threads // 2)
+        batch = max(self.min_batch, self.batch // 2)
+        self.update(threads, batch, 'error %r' % error)
+
+    def update(self, threads, batch, reason):
+        if (threads, batch) != (self.threads, self.batch):
+            log.info(
+                '## tune: threads=%s batch=%s (%s)', threads, batch, reason
+            )
+        self.threads, self.batch = threads, batch
+
+    def run(self, fn, items):
+        # failed batch is retried in full, so "fn" should be idempotent
+        # or "retries" should be 0
+        results, errors, pending, jobs = [], [], [], set()
+
+        def job(start, end, tries):
+            began = time.time()
+            try:
+                res = fn(items[start:end])
+            except Exception as e:
+                self.failure(e)
+                if tries >= self.retries:
+                    errors.append(e)
+                    return
+                pending.extend(
+                    (i, min(i + self.batch, end), tries + 1)
+                    for i in range(start, end, self.batch)
+                )
+                return
+            self.success(end - start, time.time() - began)
+            results.append((start, res))
+
+        pos = 0
+        while not errors:
+            while len(jobs) < self.threads and (pending or pos < len(items)):
+                if pending:
+                    start, end, tries = pending.pop(0)
+                else:
+                    start, end, tries = pos, pos + self.batch, 0
+                    pos = end = min(end, len(items))
+                jobs.add(spawn(job, start, end, tries))
+            if not jobs:
+                break
+            wait(jobs, count=1)
+            jobs = {j for j in jobs if not j.ready()}
+        wait(jobs)
+
+        if errors:
+            raise ValueError('Exception in the pool: %s' % errors)
+        return [res for start, res in sorted(results, key=lambda i: i[0])]
+
+
 class Uids:
-    __slots__ = ['val', 'batches', 'threads']
+    __slots__ = ['val', 'batches', 'threads', 'tune', '_str']
+
+    # Dovecot rejects lines longer than "imap_max_line_length" (64k)
+    max_size = 60000
 
-    def __init__(self, uids, *, batch=10000, threads=10):
+    def __init__(
+        self, uids, *, batch=None, size=None, threads=10, tune=False,
+        retries=2
+    ):
         if isinstance(uids, Uids):
             uids = uids.val
         self.threads = threads
-        self.val = uids
         self.batches = None
-        if not self.is_str and len(uids) > batch:
-            self.batches = tuple(
-                Uids(uids[i:i+batch], batch=batch)
-                for i in range(0, len(uids), batch)
+        self.tune = None
+        self._str = None
+        if isinstance(uids, (str, bytes)):
+            self.val = uids
+            return
+
+        self.val = array('I', (int(i) for i in uids))
+        if tune:
+            # batches are taken lazily with the size chosen by Tune
+            self.tune = Tune(batch or 1000, threads, retries=retries)
+            return
+
+        size = size or self.max_size
+        if batch and len(self.val) > batch:
+            few = (
+                Uids(self.val[i:i+batch], size=size)
+                for i in range(0, len(self.val), batch)
             )
+        elif len(self.val) > 1 and len(self.str) > size:
+            # keep original order, callers can rely on it (sorted by date)
+            parts = len(self.str) // size + 1
+            step = len(self.val) // parts + 1
+            few = (
+                Uids(self.val[i:i+step], size=size)
+                for i in range(0, len(self.val), step)
+            )
+        else:
+            return
+        self.batches = tuple(
+            i for f in few for i in (f.batches or [f])
+        )
 
     @property
     def str(self):
         if self.is_str:
             return self.val
-        return ','.join(str(i) for i in self.val)
+        if self._str is None:
+            self._str = pack_uids(self.val)
+        return self._str
 
     @property
     def is_str(self):
@@ -490,6 +1093,15 @@ class Uids:
         return [f() for f in self._call(fn, *args)]
 
     def call_async(self, fn, *args):
+        if self.tune:
+            num = [i for i, a in enumerate(args) if self is a][0]
+
+            def inner(few):
+                args_ = list(args)
+                args_[num] = Uids(few)
+                return fn_time(ft.partial(fn, *args_), fn_desc(fn, *args_))()
+            return self.tune.run(inner, self.val)
+
         if not self.batches:
             return self.call(fn, *args)
 
@@ -0,0 +1,712 @@
+import fcntl
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import zlib
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping
+from contextlib import contextmanager
+
+from gevent import sleep
+from gevent.lock import RLock
+
+from . import conf, get_user, imap, message
+
+backends = {}
+locks = {}
+
+
+@contextmanager
+def write_lock():
+    # Writers of the user are serialized: by a lock in the process and
+    # by flock between processes, it's reentrant for the same greenlet
+    user = get_user()
+    lock, held = locks.setdefault(user, (RLock(), {}))
+    with lock:
+        if held.get('fd') is not None:
+            yield
+            return
+
+        name = hashlib.md5(user.encode()).hexdigest()
+        path = os.path.join(tempfile.gettempdir(), 'mailur-index-%s' % name)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    # don't block the hub while another process writes
+                    sleep(0.01)
+            held['fd'] = fd
+            yield
+        finally:
+            held['fd'] = None
+            os.close(fd)
+
+
+class Metadata:
+    # Index is split into shards by crc32 of a key, every shard is a JSON
+    # object in its own METADATA entry, so an update rewrites only shards
+    # with changed keys
+    def __init__(self, shards=256):
+        self.shards = shards
+
+    def key(self, name, shard=None):
+        key = 'index/%s' % name
+        return key if shard is None else '%s/%03x' % (key, shard)
+
+    def shard(self, key):
+        return zlib.crc32(key.encode()) % self.shards
+
+    def get(self, con, box, name):
+        res = con.getmetadata(box, self.key(name), depth=1)
+        data = {}
+        for value in imap.parse_metadata(res).values():
+            data.update(json.loads(value.decode()))
+        return data
+
+    def get_keys(self, con, box, name, keys):
+        shards = {self.shard(k) for k in keys}
+        if not shards:
+            return {}
+        keys = set(keys)
+        res = con.getmetadata(box, *(self.key(name, i) for i in shards))
+        data = {}
+        for value in imap.parse_metadata(res).values():
+            data.update(
+                (k, v) for k, v in json.loads(value.decode()).items()
+                if k in keys
+            )
+        return data
+
+    def update(self, con, box, name, items, rm=()):
+        # shards are read, changed and written back, so it's done
+        # under write lock
+        shards = {}
+        for key in list(items) + list(rm):
+            shards.setdefault(self.shard(key), []).append(key)
+        if not shards:
+            return
+
+        keys = [self.key(name, i) for i in shards]
+        with write_lock():
+            res = imap.parse_metadata(con.getmetadata(box, *keys))
+            for shard, keys in shards.items():
+                key = self.key(name, shard)
+                data = json.loads(res[key].decode()) if key in res else {}
+                for k in keys:
+                    if k in items:
+                        data[k] = items[k]
+                    else:
+                        data.pop(k, None)
+                con.setmetadata(box, key, json.dumps(data))
+
+    def replace(self, con, box, name, items):
+        shards = {i: {} for i in range(self.shards)}
+        for key, value in items.items():
+            shards[self.shard(key)][key] = value
+        with write_lock():
+            for shard, data in shards.items():
+                con.setmetadata(box, self.key(name, shard), json.dumps(data))
+
+    def move(self, con, box_from, box_to):
+        # METADATA is moved together with renamed mailbox
+        pass
+
+
+def user_db(dbs, path, suffix, schema):
+    name = os.path.join(path, '%s%s.sqlite' % (get_user(), suffix))
+    db = dbs.get(name)
+    if db is None:
+        os.makedirs(path, exist_ok=True)
+        db = sqlite3.connect(name, isolation_level=None)
+        for sql in schema:
+            db.execute(sql)
+        dbs[name] = db
+    return db
+
+
+class SQLite:
+    # One database per user in "path" directory, "con" is not used
+    def __init__(self, path):
+        self.path = path
+        self.dbs = {}
+
+    def db(self):
+        return user_db(self.dbs, self.path, '', (
+            'CREATE TABLE IF NOT EXISTS idx ('
+            '  box TEXT, name TEXT, key TEXT, value TEXT,'
+            '  PRIMARY KEY (box, name, key)'
+            ') WITHOUT ROWID',
+        ))
+
+    def get(self, con, box, name):
+        res = self.db().execute(
+            'SELECT key, value FROM idx WHERE box = ? AND name = ?',
+            (box, name)
+        )
+        return {k: json.loads(v) for k, v in res}
+
+    def get_keys(self, con, box, name, keys):
+        keys = list(set(keys))
+        data = {}
+        for i in range(0, len(keys), 500):
+            few = keys[i:i + 500]
+            res = self.db().execute(
+                'SELECT key, value FROM idx WHERE box = ? AND name = ? '
+                'AND key IN (%s)' % ','.join('?' * len(few)),
+                [box, name] + few
+            )
+            data.update((k, json.loads(v)) for k, v in res)
+        return data
+
+    def update(self, con, box, name, items, rm=()):
+        db = self.db()
+        with db:
+            db.execute('BEGIN')
+            db.executemany(
+                'INSERT OR REPLACE INTO idx VALUES (?, ?, ?, ?)',
+                ((box, name, k, json.dumps(v)) for k, v in items.items())
+            )
+            db.executemany(
+                'DELETE FROM idx WHERE box = ? AND name = ? AND key = ?',
+                ((box, name, k) for k in rm)
+            )
+
+    def replace(self, con, box, name, items):
+        db = self.db()
+        with db:
+            db.execute('BEGIN')
+            db.execute(
+                'DELETE FROM idx WHERE box = ? AND name = ?', (box, name)
+            )
+            db.executemany(
+                'INSERT INTO idx VALUES (?, ?, ?, ?)',
+                ((box, name, k, json.dumps(v)) for k, v in items.items())
+            )
+
+    def move(self, con, box_from, box_to):
+        db = self.db()
+        with db:
+            db.execute('BEGIN')
+            db.execute('DELETE FROM idx WHERE box = ?', (box_to,))
+            db.execute(
+                'UPDATE idx SET box = ? WHERE box = ?', (box_to, box_from)
+            )
+
+
+class ParseCache:
+    # Results of "message.parsed" by sha256 of raw message and version
+    # of the parser, "deps" are other arguments which affect the result
+    def __init__(self, path, version):
+        self.path = path
+        self.version = version
+        self.dbs = {}
+
+    def db(self):
+        return user_db(self.dbs, self.path, '.parsed', (
+            'CREATE TABLE IF NOT EXISTS parsed ('
+            '  hash TEXT, version INTEGER, deps TEXT, msg BLOB, marks TEXT,'
+            '  PRIMARY KEY (hash, version, deps)'
+            ') WITHOUT ROWID',
+            'DELETE FROM parsed WHERE version != %d' % self.version,
+        ))
+
+    def get(self, sha, deps):
+        res = self.db().execute(
+            'SELECT msg, marks FROM parsed '
+            'WHERE hash = ? AND version = ? AND deps = ?',
+            (sha, self.version, json.dumps(deps))
+        ).fetchone()
+        return res and (res[0], json.loads(res[1]))
+
+    def update(self, items):
+        db = self.db()
+        with db:
+            db.execute('BEGIN')
+            db.executemany(
+                'INSERT OR REPLACE INTO parsed VALUES (?, ?, ?, ?, ?)',
+                (
+                    (sha, self.version, json.dumps(deps), msg,
+                     json.dumps(marks))
+                    for sha, deps, msg, marks in items
+                )
+            )
+
+
+def changes(*parts):
+    # {name: (items, removed keys)} for index storage
+    # by (name, data, changed keys) parts
+    return {
+        name: (
+            {k: data[k] for k in keys if k in data},
+            [k for k in keys if k not in data]
+        )
+        for name, data, keys in parts
+    }
+
+
+class Threads:
+    # Incremental thread index, messages are joined by Message-ID and
+    # References like THREAD REFS does. Only needed part is loaded:
+    #   threads: {key: {'msgs': {uid: [date, is_link, ids]}, 'latest', 'date'}}
+    #   ids: {message-id or reference: key}
+    #   uids: {uid: key}
+    # Key of thread is always uid of one of its messages.
+    def __init__(self, threads=None, ids=None, uids=None):
+        self.threads = threads or {}
+        self.ids = ids or {}
+        self.uids = uids or {}
+        self.touched = set()
+        self.before = set()
+        self.changed_ids = set()
+        self.changed_uids = set()
+
+    def touch(self, key):
+        if key in self.touched:
+            return
+        self.touched.add(key)
+        if self.threads.get(key, {}).get('latest'):
+            self.before.add(self.threads[key]['latest'])
+
+    def join(self, key, uid, msg):
+        self.threads[key]['msgs'][uid] = msg
+        self.uids[uid] = key
+        self.changed_uids.add(uid)
+        for i in msg[2]:
+            self.ids[i] = key
+            self.changed_ids.add(i)
+
+    def add(self, uid, date, is_link, ids):
+        if uid in self.uids:
+            return
+
+        keys = {self.ids[i] for i in ids if i in self.ids}
+        if keys:
+            key = max(keys, key=lambda k: (len(self.threads[k]['msgs']), k))
+        else:
+            key = uid
+            self.threads[key] = {'msgs': {}}
+        self.touch(key)
+        for other in keys - {key}:
+            self.touch(other)
+            for i, msg in self.threads.pop(other)['msgs'].items():
+                self.join(key, i, msg)
+        self.join(key, uid, [date, is_link, ids])
+
+    def remove(self, uid):
+        key = self.uids.pop(uid, None)
+        if key is None:
+            return
+        self.changed_uids.add(uid)
+        self.touch(key)
+        msgs = self.threads.pop(key)['msgs']
+        removed = msgs.pop(uid)
+        self.changed_ids.update(removed[2])
+        for i in removed[2]:
+            self.ids.pop(i, None)
+
+        # the rest of messages can be split into several threads
+        parents = {}
+
+        def find(i):
+            parents.setdefault(i, i)
+            while parents[i] != i:
+                parents[i] = parents[parents[i]]
+                i = parents[i]
+            return i
+
+        for i, msg in msgs.items():
+            for id_ in msg[2]:
+                parents[find(id_)] = find(i)
+        groups = {}
+        for i, msg in msgs.items():
+            groups.setdefault(find(i), {})[i] = msg
+        for group in groups.values():
+            new_key = key if key in group else min(group, key=int)
+            self.threads[new_key] = {'msgs': {}}
+            self.touch(new_key)
+            for i, msg in group.items():
+                self.join(new_key, i, msg)
+
+    def latest(self):
+        # returns uids to set and to unset "#latest" flag
+        after = set()
+        for key in self.touched:
+            thr = self.threads.get(key)
+            if not thr:
+                continue
+            msgs = thr['msgs']
+            uids = [i for i, m in msgs.items() if not m[1]] or list(msgs)
+            thr['latest'] = max(uids, key=lambda i: (msgs[i][0] or 0, int(i)))
+            thr['date'] = msgs[thr['latest']][0]
+            after.add(thr['latest'])
+        before = {i for i in self.before if i in self.uids}
+        return after - before, before - after
+
+    def changes(self):
+        return changes(
+            ('threads', self.threads, self.touched),
+            ('threads/ids', self.ids, self.changed_ids),
+            ('threads/uids', self.uids, self.changed_uids),
+        )
+
+
+def summary(msgs, latest, special_tag=None):
+    # Aggregates {uid: [date, flags, from, draft_id]} of thread messages
+    # like thrs_info does, returns (uid, flags, addrs, draft_id), where
+    # "uid" is a message for thread info, or None if nothing to show
+    shown = []
+    for uid, msg in msgs.items():
+        if special_tag:
+            if special_tag not in msg[1]:
+                continue
+        elif {'#trash', '#spam'}.intersection(msg[1]):
+            continue
+        shown.append(uid)
+    if not shown:
+        return None
+
+    shown.sort(key=lambda i: (msgs[i][0] or 0, int(i)))
+    flags = set()
+    unseen = False
+    draft_id = None
+    for uid in shown:
+        msg_flags = msgs[uid][1]
+        if not msg_flags:
+            continue
+        if '\\Seen' not in msg_flags:
+            unseen = True
+        if '\\Draft' in msg_flags:
+            draft_id = msgs[uid][3]
+        flags.update(msg_flags)
+    if unseen:
+        flags.discard('\\Seen')
+    uid = latest if latest in shown else shown[-1]
+    return uid, sorted(flags), [msgs[i][2] for i in shown], draft_id
+
+
+class Unread:
+    # Counters of unread messages by flags, updated with flags of changed
+    # messages. Only unseen messages which are not links are tracked:
+    #   msgs: {uid: flags}
+    #   counts: {flag: [unread, hidden]}
+    # where "hidden" are messages in #trash or #spam.
+    def __init__(self, msgs=None, counts=None):
+        self.msgs = msgs or {}
+        self.counts = counts or {}
+        self.changed_uids = set()
+        self.changed_flags = set()
+
+    def count(self, flags, inc):
+        hide_flags = None
+        if '#trash' in flags:
+            hide_flags = {'#trash'}
+        elif '#spam' in flags:
+            hide_flags = {'#spam'}
+        for f in flags:
+            count = self.counts.setdefault(f, [0, 0])
+            count[0] += inc
+            if hide_flags and hide_flags - {f}:
+                count[1] += inc
+            if not count[0]:
+                del self.counts[f]
+            self.changed_flags.add(f)
+
+    def update(self, uid, flags):
+        self.remove(uid)
+        if '\\Seen' in flags or '#link' in flags:
+            return
+        self.msgs[uid] = list(flags)
+        self.changed_uids.add(uid)
+        self.count(flags, 1)
+
+    def remove(self, uid):
+        flags = self.msgs.pop(uid, None)
+        if flags is None:
+            return
+        self.changed_uids.add(uid)
+        self.count(flags, -1)
+
+    def unread(self):
+        return {k: u - h for k, (u, h) in self.counts.items() if u != h}
+
+    def changes(self):
+        return changes(
+            ('unread/msgs', self.msgs, self.changed_uids),
+            ('unread/counts', self.counts, self.changed_flags),
+        )
+
+
+class Bitmaps:
+    # Flags of messages as bitmaps keyed by uid: bit N of "flags[flag]"
+    # is set if message with UID N has the flag. Python ints are used
+    # as bitmaps, so set operations are done in C. "dates" are used to
+    # sort like SORT (DATE) does: by sent date, then by uid.
+    system = {
+        'seen': '\\Seen', 'flagged': '\\Flagged', 'draft': '\\Draft',
+        'answered': '\\Answered', 'deleted': '\\Deleted',
+    }
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.flags = {}
+        self.exists = 0
+        self.dates = array('q')
+        self.state = {}
+
+    @staticmethod
+    def bitmap(uids):
+        uids = [int(i) for i in uids]
+        if not uids:
+            return 0
+        data = bytearray(max(uids) // 8 + 1)
+        for i in uids:
+            data[i >> 3] |= 1 << (i & 7)
+        return int.from_bytes(data, 'little')
+
+    def update(self, msgs, dates=None):
+        # "msgs" are {uid: flags} of changed messages, "dates" are
+        # {uid: date} of new ones
+        changed = self.bitmap(msgs)
+        added = {}
+        for uid, flags in msgs.items():
+            for f in flags:
+                added.setdefault(f, []).append(uid)
+        flags = {}
+        for f in set(self.flags) | set(added):
+            bits = self.flags.get(f, 0) & ~changed
+            bits |= self.bitmap(added.get(f, ()))
+            if bits:
+                flags[f] = bits
+        self.flags = flags
+        self.exists |= changed
+
+        dates = {int(k): v for k, v in (dates or {}).items()}
+        if dates and len(self.dates) <= max(dates):
+            self.dates.extend([0] * (max(dates) + 1 - len(self.dates)))
+        for uid, date in dates.items():
+            self.dates[uid] = date
+
+    def expunge(self, uids):
+        # keeps only given uids
+        exists = self.bitmap(uids)
+        self.exists &= exists
+        self.flags = {
+            f: b & exists for f, b in self.flags.items() if b & exists
+        }
+
+    @classmethod
+    def parse(cls, criteria):
+        # [(flag or uid set, is_negative), ...] for criteria which consist
+        # of flags, keywords and uids only, otherwise None
+        terms = []
+        tokens = iter(criteria.split())
+        for token in tokens:
+            key = token.lower()
+            if key == 'all':
+                continue
+            elif key in ('uid', 'keyword', 'unkeyword'):
+                value = next(tokens, None)
+                if value is None:
+                    return None
+                elif key == 'uid':
+                    if not re.match(r'^[\d:*,]+$', value):
+                        return None
+                    terms.append(({'uid': value}, False))
+                else:
+                    terms.append((value, key == 'unkeyword'))
+            elif key in cls.system:
+                terms.append((cls.system[key], False))
+            elif key[:2] == 'un' and key[2:] in cls.system:
+                terms.append((cls.system[key[2:]], True))
+            else:
+                return None
+        return terms
+
+    def uid_set(self, value):
+        last = self.exists.bit_length() - 1
+        bits = 0
+        if last < 0:
+            return bits
+        for item in value.split(','):
+            ends = [last if i == '*' else int(i) for i in item.split(':')]
+            start, end = min(ends), min(max(ends), last)
+            if start > last:
+                continue
+            bits |= (1 << (end + 1)) - (1 << start)
+        return bits
+
+    def search(self, terms):
+        bits = self.exists
+        for term, negative in terms:
+            if isinstance(term, dict):
+                found = self.uid_set(term['uid'])
+            else:
+                found = self.flags.get(term, 0)
+            bits &= ~found if negative else found
+        return bits
+
+    def uids(self, bits, reverse=False):
+        found = []
+        line = bin(bits)[:1:-1]
+        i = line.find('1')
+        while i != -1:
+            found.append(i)
+            i = line.find('1', i + 1)
+        dates = self.dates
+        found.sort(
+            key=lambda i: (dates[i] if i < len(dates) else 0, i),
+            reverse=reverse
+        )
+        return [str(i) for i in found]
+
+
+class UidMap(Mapping):
+    # Read-only {uid: uid} mapping on two arrays sorted by key,
+    # lookups are done with bisect
+    __slots__ = ['left', 'right']
+
+    def __init__(self, items=()):
+        pairs = sorted((int(k), int(v)) for k, v in dict(items).items())
+        self.left = array('I', (k for k, _ in pairs))
+        self.right = array('I', (v for _, v in pairs))
+
+    def index(self, key):
+        try:
+            key = int(key)
+        except (TypeError, ValueError):
+            raise KeyError(key)
+        i = bisect_left(self.left, key)
+        if i == len(self.left) or self.left[i] != key:
+            raise KeyError(key)
+        return i
+
+    def __getitem__(self, key):
+        return str(self.right[self.index(key)])
+
+    def __contains__(self, key):
+        try:
+            self.index(key)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        return (str(i) for i in self.left)
+
+    def __len__(self):
+        return len(self.left)
+
+    def inverse(self):
+        return UidMap(zip(self.right, self.left))
+
+
+class MidMap(Mapping):
+    # Read-only {message-id: [uid, ...]} mapping, entries are sorted by
+    # 64-bit hash of message-id, so lookup is bisect by hash. Message-IDs
+    # are kept in one blob to check for collisions: entries with the same
+    # hash are neighbours and are compared one by one.
+    __slots__ = ['hashes', 'mids', 'mid_pos', 'uids', 'uid_pos']
+
+    def __init__(self, items=()):
+        entries = sorted(
+            (self.hash(mid), mid.encode(), uids)
+            for mid, uids in dict(items).items()
+        )
+        self.hashes = array('Q', (i[0] for i in entries))
+        self.mids = b''.join(i[1] for i in entries)
+        self.mid_pos = array('I', [0])
+        self.uids = array('I')
+        self.uid_pos = array('I', [0])
+        for _, mid, uids in entries:
+            self.mid_pos.append(self.mid_pos[-1] + len(mid))
+            self.uids.extend(int(i) for i in uids)
+            self.uid_pos.append(len(self.uids))
+
+    @staticmethod
+    def hash(mid):
+        digest = hashlib.blake2b(mid.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, 'little')
+
+    def mid(self, i):
+        return self.mids[self.mid_pos[i]:self.mid_pos[i + 1]]
+
+    def index(self, mid):
+        if not isinstance(mid, str):
+            raise KeyError(mid)
+        h = self.hash(mid)
+        raw = mid.encode()
+        i = bisect_left(self.hashes, h)
+        while i < len(self.hashes) and self.hashes[i] == h:
+            if self.mid(i) == raw:
+                return i
+            i += 1
+        raise KeyError(mid)
+
+    def __getitem__(self, mid):
+        i = self.index(mid)
+        uids = self.uids[self.uid_pos[i]:self.uid_pos[i + 1]]
+        return [str(uid) for uid in uids]
+
+    def __contains__(self, mid):
+        try:
+            self.index(mid)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        return (self.mid(i).decode() for i in range(len(self.hashes)))
+
+    def __len__(self):
+        return len(self.hashes)
+
+
+def storage():
+    kind, path = key = conf['INDEX'], conf['INDEX_PATH']
+    if key not in backends:
+        if kind == 'sqlite':
+            backends[key] = SQLite(path)
+        elif kind == 'metadata':
+            backends[key] = Metadata()
+        else:
+            raise ValueError('Unknown index storage: %r' % kind)
+    return backends[key]
+
+
+def parse_cache():
+    path = conf['PARSE_CACHE']
+    if not path:
+        return None
+    key = 'parse', path
+    if key not in backends:
+        backends[key] = ParseCache(path, message.VERSION)
+    return backends[key]
+
+
+def get(con, box, name):
+    return storage().get(con, box, name)
+
+
+def get_keys(con, box, name, keys):
+    return storage().get_keys(con, box, name, keys)
+
+
+def update(con, box, name, items, rm=()):
+    return storage().update(con, box, name, items, rm)
+
+
+def replace(con, box, name, items):
+    return storage().replace(con, box, name, items)
+
+
+def move(con, box_from, box_to):
+    return storage().move(con, box_from, box_to)
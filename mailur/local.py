@@ -1,15 +1,36 @@
+import datetime as dt
 import email
+import functools as ft
 import hashlib
 import imaplib
+import itertools
 import json
+import multiprocessing
 import re
-
-from gevent import joinall, socket, spawn
-
-from . import conf, fn_cache, fn_time, html, imap, log, message, user_lock
+import resource
+import time
+import uuid
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from email.utils import parsedate_to_datetime
+
+from gevent import get_hub, joinall, killall, sleep, socket, spawn, wait
+from gevent.event import Event
+from gevent.queue import Queue
+
+from . import (
+    LockError, conf, fn_cache, fn_time, get_user, html, imap, index, log,
+    message, user_lock
+)
 
 SRC = 'Src'
 ALL = 'All'
+ALL_NEXT = 'All.next'
+ALL_PREV = 'All.prev'
+SKIP_FLAGS = {'#latest', '#err', '#dup'}
+pools = {}
+worker = {}
+bitmaps_latest = weakref.WeakValueDictionary()
 
 
 class Local(imaplib.IMAP4, imap.Conn):
@@ -28,7 +49,7 @@ class Local(imaplib.IMAP4, imap.Conn):
 
 
 def connect(username=None, password=None):
-    con = Local(username or conf['USER'])
+    con = Local(username or get_user())
     if password is None:
         con.login_root()
     else:
@@ -39,18 +60,27 @@ def connect(username=None, password=None):
     return con
 
 
+def pool(username=None):
+    username = username or get_user()
+    if username not in pools:
+        def connect_user():
+            return connect(username)
+
+        pools[username] = imap.ConnPool(ft.partial(
+            imap.client, connect_user, dovecot=True, writable=True
+        ))
+    return pools[username]
+
+
 def client(box=ALL, readonly=True):
-    ctx = imap.client(connect, dovecot=True, writable=True)
-    if box:
-        ctx.select(box, readonly=readonly)
-    return ctx
+    return pool().get(box, readonly)
 
 
 def using(box=ALL, readonly=True, name='con'):
     return imap.using(client, box, readonly, name)
 
 
-@fn_cache
+@fn_cache(version=lambda: data_version(SRC, 'tags'), shared=True)
 @using(None)
 def saved_tags(con=None):
     res = con.getmetadata(SRC, 'tags')
@@ -59,13 +89,15 @@ def saved_tags(con=None):
     return json.loads(res[0][1].decode())
 
 
-def get_tag(name):
+def get_tag(name, tags=None):
+    # "tags" are result of saved_tags, if it's already taken for the request
     if re.match(r'(?i)^[\\]?[a-z0-9/#\-.,:;!?]*$', name):
         tag = name
     else:
         tag = '#' + hashlib.md5(name.lower().encode()).hexdigest()[:8]
 
-    tags = saved_tags()
+    if tags is None:
+        tags = saved_tags()
     info = tags.get(tag)
     if info is None:
         info = {'name': name}
@@ -73,6 +105,7 @@ def get_tag(name):
             tags[tag] = info
             with client(None) as con:
                 con.setmetadata(SRC, 'tags', json.dumps(tags))
+                save_data_version(con, SRC, 'tags')
             log.info('## new tag %s: %r', tag, name)
             saved_tags.cache_clear()
     info.update(id=tag)
@@ -80,39 +113,32 @@ def get_tag(name):
 
 
 @fn_time
-@using()
-def save_uid_pairs(uids=None, con=None):
+@using(None)
+def save_uid_pairs(uids=None, box=ALL, con=None):
+    con.select(box)
+    pairs = {}
+    for msg in con.fetch_iter(uids or '1:*', '(UID BODY.PEEK[1])'):
+        origin_uid = json.loads(msg.body.decode())['origin_uid']
+        pairs[origin_uid] = msg.uid
     if uids:
-        uid_pairs.cache_clear()
-        pairs, _ = uid_pairs()
+        index.update(con, box, 'uidpairs', pairs)
     else:
-        uids = '1:*'
-        pairs = {}
-    res = con.fetch(uids, '(UID BODY.PEEK[1])')
-    for i in range(0, len(res), 2):
-        uid = res[i][0].decode().split()[2]
-        origin_uid = json.loads(res[i][1].decode())['origin_uid']
-        pairs[origin_uid] = uid
-    con.setmetadata(ALL, 'uidpairs', json.dumps(pairs))
+        index.replace(con, box, 'uidpairs', pairs)
+    save_data_version(con, box, 'uidpairs')
     uid_pairs.cache_clear()
 
 
-@fn_cache
+@fn_cache(version=lambda box=ALL: data_version(box, 'uidpairs'), shared=True)
 @fn_time
 @using(None)
-def uid_pairs(con=None):
-    res = con.getmetadata(ALL, 'uidpairs')
-    if len(res) == 1:
-        return {}, {}
-
-    origin = json.loads(res[0][1].decode())
-    parsed = {v: k for k, v in origin.items()}
-    return origin, parsed
+def uid_pairs(box=ALL, con=None):
+    origin = index.UidMap(index.get(con, box, 'uidpairs'))
+    return origin, origin.inverse()
 
 
 @fn_time
-def pair_origin_uids(uids):
-    origin, _ = uid_pairs()
+def pair_origin_uids(uids, box=ALL):
+    origin, _ = uid_pairs() if box == ALL else uid_pairs(box)
     return tuple(origin[i] for i in uids if i in origin)
 
 
@@ -130,115 +156,288 @@ def pair_msgid(mid):
 @fn_time
 @using(SRC)
 def save_msgids(uids=None, rm=False, con=None):
-    if uids:
-        mids = msgids()
-    else:
-        uids = '1:*'
-        mids = {}
-    res = con.fetch(uids, 'BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)]')
-    for i in range(0, len(res), 2):
-        uid = res[i][0].decode().split()[2]
-        line = res[i][1].strip()
+    mids = msgids() if uids else {}
+    changed = {}
+    fields = 'BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)]'
+    for msg in con.fetch_iter(uids or '1:*', fields):
+        uid = msg.uid
+        line = msg.body.strip()
         if line:
             mid = email.message_from_bytes(line)['message-id'].strip().lower()
         else:
             mid = '<mailur@noid>'
 
-        uids = mids.get(mid, [])
-        if rm and len(uids) == 1:
-            del mids[mid]
-        elif rm:
-            uids.remove(uid)
-            mids[mid] = uids
+        mid_uids = list(changed.get(mid, mids.get(mid, [])))
+        if rm:
+            if uid in mid_uids:
+                mid_uids.remove(uid)
         else:
-            uids.append(uid)
-            if len(uids) > 1:
-                uids = sorted(uids, key=lambda i: int(i))
-            mids[mid] = uids
-    con.setmetadata(SRC, 'msgids', json.dumps(mids))
+            mid_uids.append(uid)
+            if len(mid_uids) > 1:
+                mid_uids = sorted(mid_uids, key=lambda i: int(i))
+        changed[mid] = mid_uids
+
+    if uids:
+        removed = [k for k, v in changed.items() if not v]
+        changed = {k: v for k, v in changed.items() if v}
+        index.update(con, SRC, 'msgids', changed, removed)
+    else:
+        index.replace(con, SRC, 'msgids', changed)
+    save_data_version(con, SRC, 'msgids')
     msgids.cache_clear()
 
 
-@fn_cache
+@fn_cache(version=lambda: data_version(SRC, 'msgids'), shared=True)
 @fn_time
 @using(None)
 def msgids(con=None):
-    res = con.getmetadata(SRC, 'msgids')
-    if len(res) == 1:
-        return {}
-
-    return json.loads(res[0][1].decode())
+    return index.MidMap(index.get(con, SRC, 'msgids'))
 
 
 @fn_time
-@using()
-def save_addrs(uids=None, con=None):
-    def fill(store, meta, fields):
-        addrs = (meta[i] for i in fields if meta.get(i))
-        addrs = sum(([a] if isinstance(a, dict) else a for a in addrs), [])
-        for addr in addrs:
+@using(None)
+def save_addrs(uids=None, box=ALL, con=None):
+    def fill(store, changed, meta, fields):
+        for addr in meta_addrs(meta, *fields):
             a = addr['addr']
             if a not in store or store[a] != addr:
                 addr['time'] = meta['date']
-                store[a] = addr
+                store[a] = changed[a] = addr
             elif store[a]['time'] < meta['date']:
                 store[a]['time'] = meta['date']
+                changed[a] = store[a]
 
+    con.select(box)
+    metas = (
+        (
+            json.loads(msg.body.decode()),
+            bool({'#sent', '\\Draft'}.intersection(msg.flags))
+        )
+        for msg in con.fetch_iter(uids or '1:*', '(FLAGS BODY.PEEK[1])')
+    )
     if uids:
-        addrs_from, addrs_to = get_addrs()
+        # only addresses of given messages are read and written back
+        metas = list(metas)
+        keys_to, keys_from = set(), set()
+        for meta, is_from in metas:
+            keys_to.update(
+                a['addr'] for a in meta_addrs(meta, 'from', 'to', 'cc')
+            )
+            if is_from:
+                keys_from.update(a['addr'] for a in meta_addrs(meta, 'from'))
+        addrs_from = index.get_keys(con, SRC, 'addresses/from', keys_from)
+        addrs_to = index.get_keys(con, SRC, 'addresses/to', keys_to)
     else:
-        uids = '1:*'
         addrs_from, addrs_to = {}, {}
 
-    res = con.fetch(uids, '(FLAGS BODY.PEEK[1])')
-    for i in range(0, len(res), 2):
-        meta = json.loads(res[i][1].decode())
-        fill(addrs_to, meta, ('from', 'to', 'cc'))
-        flags = re.search(r'FLAGS \(([^)]*)\)', res[i][0].decode()).group(1)
-        if {'#sent', '\\Draft'}.intersection(flags.split()):
-            fill(addrs_from, meta, ('from',))
+    changed_from, changed_to = {}, {}
+    for meta, is_from in metas:
+        fill(addrs_to, changed_to, meta, ('from', 'to', 'cc'))
+        if is_from:
+            fill(addrs_from, changed_from, meta, ('from',))
+
+    save = index.update if uids else index.replace
+    save(con, SRC, 'addresses/from', changed_from)
+    save(con, SRC, 'addresses/to', changed_to)
+
 
-    data = json.dumps([addrs_from, addrs_to])
-    con.setmetadata(SRC, 'addresses', data)
+def meta_addrs(meta, *fields):
+    items = (meta[i] for i in fields if meta.get(i))
+    return sum(([a] if isinstance(a, dict) else a for a in items), [])
 
 
 @using(None)
 def get_addrs(con=None):
-    res = con.getmetadata(SRC, 'addresses')
-    if len(res) == 1:
-        return {}, {}
-
-    data = res[0][1].decode()
-    addrs_from, addrs_to = json.loads(data)
+    addrs_from = index.get(con, SRC, 'addresses/from')
+    addrs_to = index.get(con, SRC, 'addresses/to')
     return addrs_from, addrs_to
 
 
+class Budget:
+    # Bytes in pipes limited by "limit", "take" waits for room
+    # (single item bigger than limit gets in alone)
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self.room = Event()
+        self.room.set()
+
+    def take(self, size):
+        while self.size and self.size + size > self.limit:
+            self.room.clear()
+            self.room.wait()
+        self.size += size
+
+    def give(self, size):
+        self.size -= size
+        self.room.set()
+
+
+class Pipe:
+    # Queue between pipeline stages limited by size of items in bytes,
+    # pipes of the same stage in concurrent pipelines can share "budget"
+    def __init__(self, limit=None, budget=None):
+        self.budget = budget or Budget(limit)
+        self.size = 0
+        self.queue = Queue()
+
+    def put(self, item, size):
+        self.budget.take(size)
+        self.size += size
+        self.queue.put((item, size))
+
+    def close(self):
+        self.queue.put(StopIteration)
+
+    def __iter__(self):
+        for item, size in self.queue:
+            self.size -= size
+            self.budget.give(size)
+            yield item
+
+
+def pipeline(*stages):
+    # every stage runs in own greenlet, if one fails others are killed
+    jobs = [spawn(i) for i in stages]
+    try:
+        joinall(jobs, raise_error=True)
+    finally:
+        killall(jobs)
+    return [j.value for j in jobs]
+
+
+def parse_init(mids):
+    # initializer of worker processes for parsing
+    worker['mids'] = mids
+
+
+def parse_one(raw, uid, time, flags, mids=None):
+    mids = worker['mids'] if mids is None else mids
+    msg_obj, marks = message.parsed(raw, uid, time, flags, mids)
+    return msg_obj.as_bytes(), marks
+
+
+def parse_budgets():
+    # one budget of "PARSE_BUFFER" bytes per stage for all batches,
+    # so memory doesn't grow with amount of threads
+    stages = ('fetched', 'pending', 'parsed')
+    return {i: Budget(conf['PARSE_BUFFER']) for i in stages}
+
+
 @using(SRC)
-def parse_msgs(uids, con=None):
-    res = con.fetch(uids.str, '(UID INTERNALDATE FLAGS BODY.PEEK[])')
+def parse_msgs(
+    uids, stats=None, procs=None, box=ALL, budgets=None, con=None
+):
+    # fetching, parsing and appending are overlapped, memory is bounded
+    # by "budgets" of pipes; with "procs" process pool messages are parsed
+    # in worker processes
+    budgets = budgets or parse_budgets()
+    fetched = Pipe(budget=budgets['fetched'])
+    parsed = Pipe(budget=budgets['parsed'])
+    stats = {'msgs': 0, 'bytes': 0, 'cached': 0} if stats is None else stats
+    cache = index.parse_cache()
+    to_cache = []
     mids = msgids()
 
-    def msgs():
-        for i in range(0, len(res), 2):
-            m = res[i]
-            uid, time, flags = re.search(
-                r'UID (\d+) INTERNALDATE ("[^"]+") FLAGS \(([^)]*)\)',
-                m[0].decode()
-            ).groups()
-            flags = flags.split()
-            if flags.count('\\Recent'):
-                flags.remove('\\Recent')
-            msg_obj, marks = message.parsed(m[1], uid, time, flags, mids)
-            flags += marks
-            msg = msg_obj.as_bytes()
-            yield time, ' '.join(flags), msg
-
-    return con.multiappend(ALL, list(msgs()))
+    def fetch():
+        fields = '(UID INTERNALDATE FLAGS BODY.PEEK[])'
+        for m in con.fetch_iter(uids.str, fields):
+            if m.flags.count('\\Recent'):
+                m.flags.remove('\\Recent')
+            fetched.put(m, len(m.body))
+        fetched.close()
+
+    def cached(m):
+        if not cache:
+            return None, None
+        key = (
+            hashlib.sha256(m.body).hexdigest(),
+            message.parsed_deps(m.body, m.uid, m.time, m.flags, mids)
+        )
+        res = cache.get(*key)
+        if res:
+            stats['cached'] += 1
+        return key, res
+
+    def done(m, key, res, new=True):
+        msg, marks = res
+        if cache and new and '\\Draft' not in m.flags and '#dup' not in marks:
+            to_cache.append(key + res)
+            if len(to_cache) >= 100:
+                cache.update(to_cache)
+                to_cache.clear()
+
+        flags = m.flags + marks
+        parsed.put((m.time, ' '.join(flags), msg), len(msg))
+        stats['msgs'] += 1
+        stats['bytes'] += len(m.body)
+
+    def parse():
+        for m in fetched:
+            key, res = cached(m)
+            if res:
+                done(m, key, res, new=False)
+            else:
+                res = parse_one(m.body, m.uid, m.time, m.flags, mids)
+                done(m, key, res)
+        parsed.close()
+
+    def submit():
+        for m in fetched:
+            key, res = cached(m)
+            if not res:
+                res = procs.submit(parse_one, m.body, m.uid, m.time, m.flags)
+                futures.add(res)
+            pending.put((m, key, res), len(m.body))
+        pending.close()
+
+    def collect():
+        for m, key, res in pending:
+            if isinstance(res, tuple):
+                done(m, key, res, new=False)
+            else:
+                done(m, key, get_hub().threadpool.apply(res.result))
+                futures.discard(res)
+        parsed.close()
+
+    def append():
+        msgs = iter(parsed)
+        first = next(msgs, None)
+        if first is None:
+            return ''
+        with client(None) as con_all:
+            return con_all.multiappend(box, itertools.chain([first], msgs))
+
+    if procs:
+        pending = Pipe(budget=budgets['pending'])
+        futures = set()
+        stages = fetch, submit, collect, append
+    else:
+        stages = fetch, parse, append
+    try:
+        res = pipeline(*stages)[-1]
+    finally:
+        if procs:
+            # "cancel_futures" of "shutdown" is only since Python 3.9
+            for f in futures:
+                f.cancel()
+    if to_cache:
+        cache.update(to_cache)
+    return res
+
+
+def parse_procs(count):
+    if not count:
+        return None
+    return ProcessPoolExecutor(
+        count, multiprocessing.get_context('spawn'),
+        initializer=parse_init, initargs=(msgids(),)
+    )
 
 
 @fn_time
 @user_lock('parse')
-def parse(criteria=None, **opts):
+def parse(criteria=None, procs=0, **opts):
     con = client(SRC)
     uidnext = 1
     if criteria is None:
@@ -267,6 +466,8 @@ def parse(criteria=None, **opts):
         else:
             puids = pair_origin_uids(uids)
         if puids:
+            if puids != '1:*':
+                forget_threads(puids, con=con)
             con.select(ALL, readonly=False)
             puids = imap.Uids(puids)
             log.info('## deleting %s from %r', puids, ALL)
@@ -274,67 +475,356 @@ def parse(criteria=None, **opts):
             con.expunge()
 
     con.logout()
-    uids = imap.Uids(uids, **opts)
-    puids = ','.join(uids.call_async(parse_msgs, uids))
+    # messages are appended to All, so failed batches aren't retried
+    uids = imap.Uids(uids, retries=0, **opts)
+    stats = {'msgs': 0, 'bytes': 0, 'cached': 0}
+    start = time.time()
+    procs = parse_procs(procs)
+    try:
+        fn = ft.partial(
+            parse_msgs, stats=stats, procs=procs, budgets=parse_budgets()
+        )
+        puids = ','.join(i for i in uids.call_async(fn, uids) if i)
+    finally:
+        if procs:
+            procs.shutdown()
     if criteria.lower() == 'all' or count == '0':
         puids = '1:*'
+    duration = max(time.time() - start, 0.001)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if procs:
+        rss = max(rss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    log.info(
+        '## parsed %s messages (%.1fMB, %s from cache) for %.2fs: '
+        '%.1f msg/s, %.1fMB/s; peak RSS %.1fMB',
+        stats['msgs'], stats['bytes'] / 2 ** 20, stats['cached'], duration,
+        stats['msgs'] / duration, stats['bytes'] / 2 ** 20 / duration,
+        rss / 2 ** 10
+    )
 
     with client(ALL) as con:
         con.setmetadata(ALL, 'uidnext', str(uidnext))
         save_uid_pairs(puids)
         save_addrs(puids)
-        update_threads(con, 'UID %s' % uids.str)
+        if puids == '1:*':
+            update_threads(con)
+        else:
+            update_threads(con, 'UID %s' % uids.str)
+        update_unread(con=con)
 
 
 @fn_time
-def update_threads(con, criteria=None):
-    con.select(SRC)
-    criteria = criteria or 'ALL'
-    res = con.search(criteria)
-    src_uids = res[0].decode().split()
-    if not src_uids:
-        log.info('## all threads are updated already')
+@user_lock('reparse', timeout=None)
+def reparse(procs=0, **opts):
+    # Blue/green reparse: all messages are parsed into "All.next" while
+    # "All" is still in use, then mailboxes are swapped by renaming.
+    # It takes hours for big boxes, so "parse" lock is only taken for
+    # the swap, new messages and flags of Src are caught up before it
+    con = client(SRC)
+    res = con.status(SRC, '(UIDNEXT)')
+    uidnext = re.search(r'UIDNEXT (?P<next>\d+)', res[0].decode()).group(1)
+    modseq = box_state(con, SRC)[1]
+    uids = []
+    if int(uidnext) > 1:
+        res = con.sort('(DATE)', 'UID 1:%s' % (int(uidnext) - 1))
+        uids = res[0].decode().split()
+    try:
+        con.delete(ALL_NEXT)
+    except imap.Error:
+        pass
+    con.create(ALL_NEXT)
+    con.logout()
+    log.info('## reparse %s uids into %r', len(uids), ALL_NEXT)
+    if not uids:
+        log.info('## nothing to reparse')
         return
 
-    con.select(ALL)
-    uids = pair_origin_uids(src_uids)
-    criteria = 'UID %s' % ','.join(uids)
+    save_msgids()
+    # messages are appended to All, so failed batches aren't retried
+    uids = imap.Uids(uids, retries=0, **opts)
+    procs = parse_procs(procs)
+    try:
+        fn = ft.partial(
+            parse_msgs, procs=procs, box=ALL_NEXT, budgets=parse_budgets()
+        )
+        list(uids.call_async(fn, uids))
+    finally:
+        if procs:
+            procs.shutdown()
+
+    with client(None) as con:
+        save_uid_pairs(box=ALL_NEXT)
+        save_addrs(box=ALL_NEXT)
+        update_threads(con, box=ALL_NEXT)
+
+    # only changes since the start are applied under "parse" lock
+    with user_lock('parse'), client(None) as con:
+        uidnext = reparse_catch_up(uidnext, modseq, con)
+        con.setmetadata(ALL_NEXT, 'uidnext', uidnext)
+
+        con.rename(ALL, ALL_PREV)
+        try:
+            con.rename(ALL_NEXT, ALL)
+        except Exception:
+            con.rename(ALL_PREV, ALL)
+            raise
+        con.delete(ALL_PREV)
+        index.move(con, ALL_NEXT, ALL)
+    pool().drop(ALL, ALL_NEXT, ALL_PREV)
+    log.info('## %r is swapped with %r', ALL, ALL_NEXT)
+
+    # warm caches up (with snapshots for other processes)
+    uid_pairs.cache_clear()
+    uid_pairs()
 
-    thrs = con.thread('REFS UTF-8 INTHREAD REFS %s' % criteria)
-    if not thrs:
-        log.info('## no threads are updated')
-        return
 
-    msgs = {}
-    uids = thrs.all_uids
-    res = con.fetch(uids, '(FLAGS BODY.PEEK[1])')
-    for i in range(0, len(res), 2):
-        uid, flags = re.search(
-            r'UID (\d+) FLAGS \(([^)]*)\)', res[i][0].decode()
-        ).groups()
-        msgs[uid] = {
-            'flags': flags.split(),
-            'date': json.loads(res[i][1])['date']
-        }
+def reparse_catch_up(uidnext, modseq, con):
+    # messages added to Src while reparsing are parsed into "All.next"
+    # and changed flags are stored there, returns new UIDNEXT of Src
+    res = con.status(SRC, '(UIDNEXT)')
+    last = re.search(r'UIDNEXT (?P<next>\d+)', res[0].decode()).group(1)
+    con.select(SRC)
+    res = con.search('UID %s:*' % uidnext)
+    uids = [
+        i for i in res[0].decode().split()
+        if int(uidnext) <= int(i) < int(last)
+    ]
+    flags = changed_flags(con, modseq)
+    if uids:
+        log.info('## reparse %s new uids into %r', len(uids), ALL_NEXT)
+        puids = parse_msgs(imap.Uids(uids), box=ALL_NEXT)
+        save_uid_pairs(puids, box=ALL_NEXT)
+        save_addrs(puids, box=ALL_NEXT)
+
+    origin = uid_pairs(ALL_NEXT)[0]
+    con.select(ALL_NEXT, readonly=False)
+    targets = {origin[i]: i for i in flags if i in origin and i not in uids}
+    store_flags(con, flags, targets, SKIP_FLAGS)
+    if uids:
+        update_threads(con, 'UID %s' % ','.join(uids), box=ALL_NEXT)
+    con.select(ALL_NEXT)
+    threads_refresh(con, ALL_NEXT)
+    return last
+
 
-    latest = []
-    for thrids in thrs:
-        if len(thrids) == 1:
-            thrid = thrids[0]
+def thread_msgs(con, uids):
+    fields = (
+        '(UID FLAGS BODY.PEEK[1] '
+        'BODY.PEEK[HEADER.FIELDS (MESSAGE-ID REFERENCES)])'
+    )
+    for msg in con.fetch_iter(uids, fields):
+        meta = json.loads(msg.parts.pop('BODY[1]'))
+        headers = email.message_from_bytes(msg.body)
+        ids = ' '.join(headers.get_all('message-id', []))
+        ids += ' ' + ' '.join(headers.get_all('references', []))
+        ids = list(dict.fromkeys(ids.lower().split()))
+        yield msg.uid, msg.flags, meta, ids
+
+
+def threads_load(con, box, uids=(), ids=()):
+    uids = index.get_keys(con, box, 'threads/uids', uids)
+    ids = index.get_keys(con, box, 'threads/ids', ids)
+    keys = set(uids.values()) | set(ids.values())
+    threads = index.get_keys(con, box, 'threads', keys)
+    return index.Threads(threads, ids, uids)
+
+
+def summary_msg(flags, meta):
+    # compact data of thread message for index.summary
+    return [
+        meta['date'], sorted(flags), meta.get('from'), meta.get('draft_id')
+    ]
+
+
+def summary_metas(con, uids):
+    for msg in con.fetch_iter(uids, '(UID FLAGS BINARY.PEEK[1])'):
+        yield msg.uid, msg.flags, json.loads(msg.body)
+
+
+def summaries_save(con, box, summaries, metas=None, rm=(), rebuild=False):
+    # "view" is what thrs_info returns for the thread without special tag
+    # and "info" is meta of its message, so it's one lookup per thread
+    metas = dict(metas or {})
+    for thr in summaries.values():
+        if thr.get('info'):
+            metas.setdefault(thr['view'][0], thr['info'])
+        thr['view'] = index.summary(thr['msgs'], thr['latest'])
+        thr['info'] = thr['view'] and metas.get(thr['view'][0])
+
+    missing = {
+        thr['view'][0]: thr for thr in summaries.values()
+        if thr['view'] and not thr['info']
+    }
+    if missing:
+        for uid, _, meta in summary_metas(con, list(missing)):
+            missing[uid]['info'] = meta
+    if rebuild:
+        index.replace(con, box, 'threads/summary', summaries)
+    else:
+        index.update(con, box, 'threads/summary', summaries, rm)
+
+
+def threads_save(con, box, thrs, msgs=None, metas=None, rebuild=False):
+    # "msgs" and "metas" are known summary data of new messages:
+    # {uid: summary_msg(...)} and {uid: meta}
+    add, rm = thrs.latest()
+    for name, (items, removed) in thrs.changes().items():
+        if rebuild:
+            index.replace(con, box, name, items)
         else:
-            thrid = sorted(
-                (t for t in thrids if '#link' not in msgs[t]['flags']),
-                key=lambda i: msgs[i]['date'] or 0
-            )[-1]
-        latest.append(thrid)
+            index.update(con, box, name, items, removed)
+
+    msgs = dict(msgs or {})
+    metas = dict(metas or {})
+    if not rebuild:
+        old = index.get_keys(con, box, 'threads/summary', thrs.touched)
+        for thr in old.values():
+            for uid, msg in thr['msgs'].items():
+                msgs.setdefault(uid, msg)
+            if thr.get('info'):
+                metas.setdefault(thr['view'][0], thr['info'])
+
+    summaries = {}
+    for key in thrs.touched:
+        thr = thrs.threads.get(key)
+        if not thr:
+            continue
+        # the same order as in THREAD REFS response
+        dates = {uid: (msg[0], int(uid)) for uid, msg in thr['msgs'].items()}
+        summaries[key] = {
+            'uids': sorted(dates, key=dates.get),
+            'latest': thr['latest'],
+            'msgs': {
+                uid: msgs.get(uid) for uid, msg in thr['msgs'].items()
+                if not msg[1]
+            }
+        }
+    missing = {
+        uid: thr for thr in summaries.values()
+        for uid, msg in thr['msgs'].items() if msg is None
+    }
+    if missing:
+        for uid, flags, meta in summary_metas(con, list(missing)):
+            missing[uid]['msgs'][uid] = summary_msg(flags, meta)
+            metas[uid] = meta
+    for thr in summaries.values():
+        for uid, msg in thr['msgs'].items():
+            flags = set(msg[1]) - {'#latest'}
+            if uid == thr['latest']:
+                flags.add('#latest')
+            msg[1] = sorted(flags)
+    summaries_save(
+        con, box, summaries, metas,
+        rm=[k for k in thrs.touched if k not in thrs.threads],
+        rebuild=rebuild
+    )
+
+    con.select(box, readonly=False)
+    if rebuild:
+        res = con.search('KEYWORD #latest')
+        rm = set(res[0].decode().split()) - add
+    if rm:
+        con.store(rm, '-FLAGS.SILENT', '#latest')
+    if add:
+        con.store(add, '+FLAGS.SILENT', '#latest')
+    return add, rm
+
+
+@fn_time
+def update_threads(con, criteria=None, box=ALL):
+    # Thread index is updated by given messages of Src box,
+    # without "criteria" it's rebuilt from scratch for the whole box
+    con.select(box)
+    uidvalidity, modseq = [str(i) for i in box_state(con, box)]
+    state = index.get_keys(con, box, 'threads/state', ['uidvalidity'])
+    if criteria and state.get('uidvalidity') != uidvalidity:
+        log.info('## thread index is outdated, rebuilding')
+        criteria = None
+
+    if criteria:
+        con.select(SRC)
+        res = con.search(criteria)
+        src_uids = res[0].decode().split()
+        con.select(box)
+        uids = pair_origin_uids(src_uids, box)
+        if not uids:
+            log.info('## all threads are updated already')
+            return
+        msgs = list(thread_msgs(con, uids))
+        thrs = threads_load(con, box, uids, {i for m in msgs for i in m[3]})
+    else:
+        msgs = thread_msgs(con, '1:*')
+        thrs = index.Threads()
+
+    summaries = {}
+    metas = {}
+    for uid, flags, meta, ids in msgs:
+        thrs.add(uid, meta['date'], '#link' in flags, ids)
+        if '#link' in flags:
+            continue
+        summaries[uid] = summary_msg(flags, meta)
+        if criteria:
+            metas[uid] = meta
+    add, rm = threads_save(
+        con, box, thrs, summaries, metas, rebuild=not criteria
+    )
+    if not criteria:
+        index.update(con, box, 'threads/state', {
+            'uidvalidity': uidvalidity,
+            'modseq': modseq
+        })
+    threads_refresh(con, box)
+    log.info(
+        '## updated %s threads: +%s -%s #latest',
+        len(thrs.touched), len(add), len(rm)
+    )
+
 
-    con.select(ALL, readonly=False)
-    res = con.search('KEYWORD #latest')
-    clean = set(res[0].decode().split()).intersection(uids) - set(latest)
-    if clean:
-        con.store(clean, '-FLAGS.SILENT', '#latest')
-    con.store(latest, '+FLAGS.SILENT', '#latest')
-    log.info('## updated %s threads', len(thrs))
+def threads_state(con, box):
+    # (saved, current) MODSEQ of the thread index or None
+    # if the thread index can't be used for the box
+    uidvalidity, modseq = [str(i) for i in box_state(con, box)]
+    keys = ['uidvalidity', 'modseq']
+    state = index.get_keys(con, box, 'threads/state', keys)
+    if state.get('uidvalidity') != uidvalidity or not state.get('modseq'):
+        return None
+    return state['modseq'], modseq
+
+
+def summaries_flags(summaries, flags):
+    # changed flags are applied to thread summaries in place
+    for thr in summaries.values():
+        for uid in thr['msgs'].keys() & flags.keys():
+            thr['msgs'][uid][1] = sorted(flags[uid])
+
+
+def threads_refresh(con, box=ALL):
+    # Flags in thread summaries are updated by CONDSTORE, it's called by
+    # writers after flags are stored, so reading uses the index as is
+    state = threads_state(con, box)
+    if not state or state[0] == state[1]:
+        return
+
+    flags = changed_flags(con, state[0])
+    keys = index.get_keys(con, box, 'threads/uids', flags)
+    summaries = index.get_keys(
+        con, box, 'threads/summary', set(keys.values())
+    )
+    summaries_flags(summaries, flags)
+    summaries_save(con, box, summaries)
+    index.update(con, box, 'threads/state', {'modseq': state[1]})
+    log.debug('## refreshed flags of %s threads', len(summaries))
+
+
+@fn_time
+@using(None)
+def forget_threads(uids, box=ALL, con=None):
+    # should be called before messages are expunged from the box
+    con.select(box)
+    thrs = threads_load(con, box, uids)
+    for uid in uids:
+        thrs.remove(uid)
+    threads_save(con, box, thrs)
 
 
 @fn_time
@@ -355,6 +845,7 @@ def msgs_flag(uids, old, new, con_src=None, con_all=None):
         spawn(store, con_src, pair_parsed_uids(uids))
     ]
     joinall(jobs, raise_error=True)
+    threads_refresh(con_all)
 
 
 @fn_time
@@ -368,102 +859,251 @@ def clean_flags(con=None):
     update_threads(con)
 
 
+def box_state(con, box):
+    res = con.status(box, '(UIDVALIDITY HIGHESTMODSEQ)')
+    pair = re.search(r'UIDVALIDITY (\d+) HIGHESTMODSEQ (\d+)', res[0].decode())
+    return [int(i) for i in pair.groups()]
+
+
+def box_status(con, box):
+    res = con.status(box, '(UIDVALIDITY HIGHESTMODSEQ MESSAGES UIDNEXT)')
+    status = {
+        k.lower(): int(v)
+        for k, v in re.findall(r'([A-Z]+) (\d+)', res[0].decode())
+    }
+    status['modseq'] = status.pop('highestmodseq')
+    return status
+
+
+@using(None)
+def data_version(box, name, con=None):
+    # cached values of "name" index data are valid until it's saved again,
+    # SETMETADATA doesn't change MODSEQ, so a token is saved alongside
+    res = con.getmetadata(box, 'version/%s' % name)
+    if len(res) == 1:
+        return None
+    return res[0][1].decode()
+
+
+def save_data_version(con, box, name):
+    con.setmetadata(box, 'version/%s' % name, uuid.uuid4().hex)
+
+
+@using(None)
+def box_version(box, con=None):
+    # cached values based on messages of "box" are valid until it's changed
+    return tuple(box_state(con, box))
+
+
+def expunged(status, state, flags):
+    # CHANGEDSINCE doesn't return expunged messages, so they are found
+    # by amount of messages: saved one plus new ones from "flags"
+    new = [i for i in flags if int(i) >= state.get('uidnext', 0)]
+    return status['messages'] != state.get('messages', 0) + len(new)
+
+
+def changed_flags(con, modseq, uids='1:*'):
+    fields = '(UID FLAGS)'
+    if modseq:
+        fields += ' (CHANGEDSINCE %s)' % modseq
+    return {m.uid: m.flags for m in con.fetch_iter(uids, fields) if m.uid}
+
+
+def store_flags(con, flags, targets, skip=()):
+    # Makes flags in the selected box the same as "flags[targets[uid]]",
+    # one STORE for every (action, flags) pair
+    skip = {'\\Recent'}.union(skip)
+    actions = {}
+    for msg in con.fetch_iter(list(targets), '(UID FLAGS)'):
+        if not msg.uid:
+            continue
+        new = set(flags[targets[msg.uid]]) - skip
+        old = set(msg.flags) - skip
+        for action, val in (('+', new - old), ('-', old - new)):
+            if val:
+                action = '%sFLAGS.SILENT' % action
+                key = (action, ' '.join(sorted(val)))
+                actions.setdefault(key, [])
+                actions[key].append(msg.uid)
+    for action, uids in actions.items():
+        con.store(uids, *action)
+    return actions
+
+
+def sync_flags_changes(con_from, con_to, pairs, full, skip=()):
+    # Messages changed in any of boxes since saved MODSEQs get flags from
+    # "con_from" box. Without saved MODSEQs (or if UIDVALIDITY is changed)
+    # "full" is called instead, own changes of "full" aren't synced again.
+    box_from, box_to = con_from.box, con_to.box
+    state = {box: box_state(con_from, box) for box in (box_from, box_to)}
+    saved = flags_state(con_from, box_from, box_to)
+    if any(saved.get(k, [None])[0] != v[0] for k, v in state.items()):
+        log.info('## %s->%s: full sync', box_from, box_to)
+        full()
+        state[box_to] = box_state(con_from, box_to)
+    else:
+        forth, back = pairs
+        flags = changed_flags(con_from, saved[box_from][1])
+        res = changed_flags(con_to, saved[box_to][1])
+        uids = {back[i] for i in res if i in back} - set(flags)
+        if uids:
+            flags.update(changed_flags(con_from, None, uids))
+        targets = {forth[i]: i for i in flags if i in forth}
+        actions = store_flags(con_to, flags, targets, skip)
+        state[box_to] = stored_state(con_to, box_to, state[box_to], actions)
+        log.info(
+            '## %s->%s: %s changed, %s', box_from, box_to, len(targets),
+            {k: len(v) for k, v in actions.items()}
+        )
+    save_flags_state(con_from, box_from, box_to, state)
+
+
+def stored_state(con, box, state, actions):
+    # [UIDVALIDITY, MODSEQ] after own STOREs of "actions", so they aren't
+    # taken as changes next time. If something else is changed in the box
+    # meanwhile, "state" is kept and own changes are synced again.
+    stored = {i for uids in actions.values() for i in uids}
+    if not stored:
+        return state
+    after = box_state(con, box)
+    if set(changed_flags(con, state[1])) <= stored:
+        return after
+    return state
+
+
+def flags_state(con, box_from, box_to):
+    # {box: [UIDVALIDITY, MODSEQ]} for both boxes, flags are synced
+    # from "box_from" to "box_to" up to these MODSEQs
+    res = con.getmetadata(box_from, 'flags/%s' % box_to.lower())
+    if len(res) == 1:
+        return {}
+    return json.loads(res[0][1].decode())
+
+
+def save_flags_state(con, box_from, box_to, state):
+    key = 'flags/%s' % box_to.lower()
+    con.setmetadata(box_from, key, json.dumps(state))
+
+
 @fn_time
 @using(SRC, name='con_src')
 @using(ALL, name='con_all', readonly=False)
-def sync_flags_to_all(con_src=None, con_all=None):
-    skip_flags = set(['#latest', '#err', '#dup'])
-    for flag in con_src.flags:
-        if flag in skip_flags:
-            continue
-        q = flag[1:] if flag.startswith('\\') else 'keyword %s' % flag
-        res = con_src.search(q)
-        oids = res[0].decode().split()
-        pairs = set(pair_origin_uids(oids))
-        res = con_all.search(q)
-        pids = set(res[0].decode().split())
-        con_all.store(pairs - pids, '+FLAGS.SILENT', flag)
-        con_all.store(pids - pairs, '-FLAGS.SILENT', flag)
-    rm_flags = set(con_all.flags) - set(con_src.flags) - skip_flags
-    if rm_flags:
-        con_all.store('1:*', '-FLAGS.SILENT', ' '.join(rm_flags))
+def sync_flags_to_all(full=False, con_src=None, con_all=None):
+    def sync_all():
+        for flag in con_src.flags:
+            if flag in SKIP_FLAGS:
+                continue
+            q = flag[1:] if flag.startswith('\\') else 'keyword %s' % flag
+            res = con_src.search(q)
+            oids = res[0].decode().split()
+            pairs = set(pair_origin_uids(oids))
+            res = con_all.search(q)
+            pids = set(res[0].decode().split())
+            con_all.store(pairs - pids, '+FLAGS.SILENT', flag)
+            con_all.store(pids - pairs, '-FLAGS.SILENT', flag)
+        rm_flags = set(con_all.flags) - set(con_src.flags) - SKIP_FLAGS
+        if rm_flags:
+            con_all.store('1:*', '-FLAGS.SILENT', ' '.join(rm_flags))
+
+    if full:
+        sync_all()
+    else:
+        origin, parsed = uid_pairs()
+        sync_flags_changes(
+            con_src, con_all, (origin, parsed), sync_all, SKIP_FLAGS
+        )
+    threads_refresh(con_all)
+    update_unread(con=con_all)
 
 
 @fn_time
 @using(SRC, name='con_src', readonly=False)
 @using(ALL, name='con_all')
-def sync_flags_to_src(con_src=None, con_all=None):
-    for flag in con_all.flags:
-        if flag in ('#latest', '#err', '#dup'):
-            continue
-        q = flag[1:] if flag.startswith('\\') else 'keyword %s' % flag
-        res = con_all.search(q)
-        pids = res[0].decode().split()
-        pairs = set(pair_parsed_uids(pids))
-        res = con_src.search(q)
-        oids = set(res[0].decode().split())
-        con_src.store(pairs - oids, '+FLAGS.SILENT', flag)
-        con_src.store(oids - pairs, '-FLAGS.SILENT', flag)
-    rm_flags = set(con_src.flags) - set(con_all.flags)
-    if rm_flags:
-        con_src.store('1:*', '-FLAGS.SILENT', ' '.join(rm_flags))
+def sync_flags_to_src(full=False, con_src=None, con_all=None):
+    def sync_all():
+        for flag in con_all.flags:
+            if flag in SKIP_FLAGS:
+                continue
+            q = flag[1:] if flag.startswith('\\') else 'keyword %s' % flag
+            res = con_all.search(q)
+            pids = res[0].decode().split()
+            pairs = set(pair_parsed_uids(pids))
+            res = con_src.search(q)
+            oids = set(res[0].decode().split())
+            con_src.store(pairs - oids, '+FLAGS.SILENT', flag)
+            con_src.store(oids - pairs, '-FLAGS.SILENT', flag)
+        rm_flags = set(con_src.flags) - set(con_all.flags)
+        if rm_flags:
+            con_src.store('1:*', '-FLAGS.SILENT', ' '.join(rm_flags))
+
+    if full:
+        sync_all()
+        return
+    origin, parsed = uid_pairs()
+    sync_flags_changes(
+        con_all, con_src, (parsed, origin), sync_all, SKIP_FLAGS
+    )
 
 
 @fn_time
-@using(None)
-def sync_flags(con=None, timeout=None):
-    @using(SRC, name='con_src')
+def sync_flags(timeout=None, window=0.5):
+    # IDLE on both boxes only marks that something is changed, then
+    # all changes for "window" seconds are synced in one pass
+    changed = Event()
+
+    def watch(box):
+        with client(box) as con:
+            con.idle(lambda res: changed.set(), 'FETCH', timeout=timeout)
+
+    @using(SRC, name='con_src', readonly=False)
     @using(ALL, name='con_all', readonly=False)
-    def handler(res, con_src=None, con_all=None):
-        modseq0 = modseq[0]
-        modseq_ = re.search(r'MODSEQ \((\d+)\)', res[0].decode()).group(1)
-        if int(modseq_) < int(modseq0):
+    def sync(con_src=None, con_all=None):
+        state = {box: box_state(con_src, box) for box in (SRC, ALL)}
+        saved = flags_state(con_src, SRC, ALL)
+        if any(saved.get(k, [None])[0] != v[0] for k, v in state.items()):
+            sync_flags_to_all()
             return
-        modseq[0] = modseq_
-        res = con_src.fetch('1:*', '(UID FLAGS) (CHANGEDSINCE %s)' % modseq0)
-        src_flags = {}
-        for line in res:
-            val = re.search(r'UID (\d+) FLAGS \(([^)]*)\)', line.decode())
-            if not val:
-                continue
-            uid, flags = val.groups()
-            src_flags[uid] = flags
 
-        if not src_flags:
-            return
+        src_flags = changed_flags(con_src, saved[SRC][1])
+        all_flags = changed_flags(con_all, saved[ALL][1])
+        origin, parsed = uid_pairs()
+        to_all = {origin[i]: i for i in src_flags if i in origin}
+        # Src wins if a message is changed in both boxes
+        to_src = {
+            parsed[i]: i for i in all_flags
+            if i in parsed and parsed[i] not in src_flags
+        }
+        actions = (
+            store_flags(con_all, src_flags, to_all, SKIP_FLAGS),
+            store_flags(con_src, all_flags, to_src, SKIP_FLAGS)
+        )
+        state[ALL] = stored_state(con_all, ALL, state[ALL], actions[0])
+        state[SRC] = stored_state(con_src, SRC, state[SRC], actions[1])
+        save_flags_state(con_src, SRC, ALL, state)
+        threads_refresh(con_all)
+        update_unread(con=con_all)
+        log.info(
+            '## sync: %s->%s %s; %s->%s %s', SRC, ALL,
+            {k: len(v) for k, v in actions[0].items()}, ALL, SRC,
+            {k: len(v) for k, v in actions[1].items()}
+        )
 
-        actions = {}
-        _, parsed = uid_pairs()
-        pids = pair_origin_uids(src_flags)
-        res = con_all.fetch(pids, '(UID FLAGS)')
-        for line in res:
-            uid, flags = (
-                re.search(r'UID (\d+) FLAGS \(([^)]*)\)', line.decode())
-                .groups()
-            )
-            flags = set(flags.split())
-            orig_flags = set(src_flags[parsed[uid]].split())
-            val = sorted(orig_flags - flags - set(['\\Recent']))
-            if val:
-                key = ('+FLAGS.SILENT', ' '.join(val))
-                actions.setdefault(key, [])
-                actions[key].append(uid)
-            val = sorted(flags - orig_flags - set(['#latest']))
-            if val:
-                key = ('-FLAGS.SILENT', ' '.join(val))
-                actions.setdefault(key, [])
-                actions[key].append(uid)
-        log.debug('## sync: MODSEQ=%s %s', modseq_, actions)
-        for action, uids in actions.items():
-            con_all.store(uids, *action)
+    def worker():
+        while 1:
+            changed.wait()
+            sleep(window)
+            changed.clear()
+            sync()
 
-    res = con.status(SRC, '(UIDVALIDITY HIGHESTMODSEQ)')
-    pair = re.search(r'UIDVALIDITY (\d+) HIGHESTMODSEQ (\d+)', res[0].decode())
-    uidval, modseq = pair.groups()
-    log.info('## %s UIDVALIDITY=%s HIGHESTMODSEQ=%s', con, uidval, modseq)
-    modseq = [modseq]
-    con.select(SRC)
-    con.idle(handler, 'FETCH', timeout=timeout)
+    # catch up with changes since the last run (the full sync runs only
+    # for the first time or if UIDVALIDITY is changed)
+    sync_flags_to_all()
+    jobs = [spawn(watch, SRC), spawn(watch, ALL), spawn(worker)]
+    try:
+        for job in wait(jobs, count=1):
+            job.get()
+    finally:
+        killall(jobs)
 
 
 @fn_time
@@ -476,10 +1116,9 @@ def link_threads(uids, no_parse=False, con=None):
         uids = set(uids) - set(links)
 
     con.select(ALL)
-    res = con.fetch(uids, 'BODY.PEEK[1]')
     msgids = []
-    for i in range(0, len(res), 2):
-        meta = json.loads(res[i][1].decode())
+    for msg in con.fetch_iter(uids, 'BODY.PEEK[1]'):
+        meta = json.loads(msg.body.decode())
         if meta.get('thrid'):
             msgids.append(meta['thrid'])
         msgids.append(meta['msgid'])
@@ -499,14 +1138,13 @@ def delete_links(uids, con_src=None, con_all=None):
     res = con_all.search('INTHREAD REFS UID %s KEYWORD #link' % ','.join(uids))
     links = res[0].decode().split()
     if links:
+        forget_threads(links, con=con_all)
         src_links = pair_parsed_uids(links)
         if src_links:
             con_src.store(src_links, '+FLAGS.SILENT', '\\Deleted')
             con_src.expunge()
         con_all.store(links, '+FLAGS.SILENT', '\\Deleted')
         con_all.expunge()
-    origin_uids = pair_parsed_uids(uids)
-    update_threads(con_src, 'UID %s' % ','.join(origin_uids))
     return links
 
 
@@ -514,10 +1152,10 @@ def delete_links(uids, con_src=None, con_all=None):
 def update_links(con=None):
     res = con.search('KEYWORD #link')
     uids = res[0].decode().split()
-    res = con.fetch(uids, 'BODY.PEEK[HEADER.FIELDS (References)]')
+    res = list(con.fetch_iter(uids, 'BODY.PEEK[HEADER.FIELDS (References)]'))
     mids = msgids()
-    for i in range(0, len(res), 2):
-        refs = email.message_from_bytes(res[i][1])['References'].split()
+    for msg in res:
+        refs = email.message_from_bytes(msg.body)['References'].split()
         oids = [mids[i.lower()][0] for i in refs if i in mids]
         pids = pair_origin_uids(oids)
         link_threads(pids, no_parse=True)
@@ -528,8 +1166,8 @@ def update_links(con=None):
 @using(None)
 def raw_msg(uid, box, parsed=False, con=None):
     con.select(box)
-    res = con.fetch(uid, 'BODY.PEEK[]')
-    body = res[0][1] if res else None
+    res = list(con.fetch_iter(uid, 'BODY.PEEK[]'))
+    body = res[0].body if res else None
     if body and parsed:
         body = email.message_from_bytes(body)
     return body
@@ -540,9 +1178,8 @@ def raw_msg(uid, box, parsed=False, con=None):
 def raw_part(uid, box, part, con=None):
     con.select(box)
     fields = '(BINARY.PEEK[{0}] BINARY.PEEK[{0}.mime])'.format(part)
-    res = con.fetch(uid, fields)
-    body = res[0][1]
-    mime = res[1][1]
+    msg = next(con.fetch_iter(uid, fields))
+    body, mime = msg.parts.values()
     content_type = email.message_from_bytes(mime).get_content_type()
     return body, content_type
 
@@ -554,60 +1191,141 @@ def fetch_msg(uid, draft=False, con=None):
         '(FLAGS BINARY.PEEK[HEADER] BINARY.PEEK[1] BINARY.PEEK[2.%s])'
         % ('2' if draft else '1')
     )
-    res = con.fetch(uid, fields)
-    flags = re.search(r'FLAGS \(([^)]*)\)', res[0][0].decode()).group(1)
-    head = email.message_from_string(res[0][1].decode())
-    meta = json.loads(res[1][1].decode())
-    txt = res[2][1].decode()
+    msg = next(con.fetch_iter(uid, fields))
+    head, meta, txt = msg.parts.values()
+    flags = ' '.join(msg.flags)
+    head = email.message_from_string(head.decode())
+    meta = json.loads(meta.decode())
+    txt = txt.decode()
     return flags, head, meta, txt
 
 
+def sort_window(con, sort, criteria, window):
+    offset, limit = window
+    ret = 'PARTIAL %s:%s COUNT' % (offset + 1, offset + limit)
+    res = con.sort(sort, criteria, ret=ret)
+    return res.get('partial', []), res.get('count', 0)
+
+
 @fn_time
 @using()
-def search_msgs(query, sort='(REVERSE DATE)', con=None):
+def search_msgs(query, sort='(REVERSE DATE)', *, window=None, con=None):
+    # with window=(offset, limit) returns one page and total count
+    uids = search_bitmaps(con, query, sort)
+    if uids is not None:
+        log.debug('## query: %r; messages: %s (bitmaps)', query, len(uids))
+        if window:
+            offset, limit = window
+            return uids[offset:offset + limit], len(uids)
+        return uids
+
+    if window:
+        uids, total = sort_window(con, sort, query, window)
+        log.debug('## query: %r; messages: %s/%s', query, len(uids), total)
+        return uids, total
+
     res = con.sort(sort, query)
     uids = res[0].decode().split()
     log.debug('## query: %r; messages: %s', query, len(uids))
     return uids
 
 
+@fn_cache(version=lambda: box_version(ALL), shared=True)
+@fn_time
+@using(None)
+def flag_bitmaps(con=None):
+    # a value is stale after any change of flags, but bitmaps of this
+    # process are still updated by MODSEQ instead of building new ones
+    con.select(ALL)
+    bitmaps = bitmaps_latest.get(get_user()) or index.Bitmaps()
+    update_bitmaps(con, bitmaps)
+    bitmaps_latest[get_user()] = bitmaps
+    return bitmaps
+
+
+def update_bitmaps(con, bitmaps):
+    # Bitmaps are updated by flags changed since the last MODSEQ
+    status = box_status(con, ALL)
+    if bitmaps.state.get('uidvalidity') != status['uidvalidity']:
+        bitmaps.clear()
+    state = bitmaps.state
+    if state.get('modseq') == status['modseq']:
+        return
+
+    flags = changed_flags(con, state.get('modseq'))
+    new = [i for i in flags if int(i) >= state.get('uidnext', 0)]
+    dates = {}
+    if new:
+        fields = '(UID INTERNALDATE BODY.PEEK[HEADER.FIELDS (DATE)])'
+        for msg in con.fetch_iter(new, fields):
+            dates[msg.uid] = sort_date(msg.body, msg.time)
+    bitmaps.update(flags, dates)
+    if expunged(status, state, flags):
+        res = con.search('ALL')
+        bitmaps.expunge(res[0].decode().split())
+    bitmaps.state = status
+
+
+def sort_date(header, time):
+    # sent date like SORT (DATE) uses, INTERNALDATE if there is no one
+    date = email.message_from_bytes(header)['date']
+    try:
+        date = parsedate_to_datetime(date)
+        if date.tzinfo is None:
+            # "-0000" zone is UTC as well, not local time
+            date = date.replace(tzinfo=dt.timezone.utc)
+        return int(date.timestamp())
+    except Exception:
+        fmt = '%d-%b-%Y %H:%M:%S %z'
+        return int(dt.datetime.strptime(time.strip('"'), fmt).timestamp())
+
+
+def search_bitmaps(con, query, sort):
+    # queries by flags, tags and uids are answered by local bitmaps,
+    # None if the query needs SEARCH
+    if sort not in ('(DATE)', '(REVERSE DATE)'):
+        return None
+    terms = index.Bitmaps.parse(query)
+    if terms is None:
+        return None
+    bitmaps = flag_bitmaps()
+    update_bitmaps(con, bitmaps)
+    return bitmaps.uids(bitmaps.search(terms), reverse=sort != '(DATE)')
+
+
 @fn_time
 @using()
 def msgs_info(uids, con=None):
-    res = con.fetch(uids, '(UID FLAGS BINARY.PEEK[1])')
-    for i in range(0, len(res), 2):
-        uid, flags = (
-            re.search(r'UID (\d+) FLAGS \(([^)]*)\)', res[i][0].decode())
-            .groups()
-        )
-        flags = flags.split()
-        yield uid, res[i][1], flags, None
+    for msg in con.fetch_iter(uids, '(UID FLAGS BINARY.PEEK[1])'):
+        yield msg.uid, msg.body, msg.flags, None
 
 
 @fn_time
 @using()
 def msgs_body(uids, fix_privacy=False, con=None):
-    res = con.fetch(uids, '(UID BINARY.PEEK[2.1])')
-    for i in range(0, len(res), 2):
-        uid = res[i][0].decode().split()[2]
-        body = res[i][1].decode()
+    for msg in con.fetch_iter(uids, '(UID BINARY.PEEK[2.1])'):
+        body = msg.body.decode()
         body = html.fix_privacy(body, only_proxy=not fix_privacy)
-        yield uid, body
+        yield msg.uid, body
 
 
 @fn_time
 @using(None)
 def msg_flags(uid, box=ALL, con=None):
     con.select(box)
-    res = con.fetch(uid, 'FLAGS')
-    flags = re.search(r'FLAGS \(([^)]*)\)', res[0].decode()).group(1)
-    return flags
+    msg = next(con.fetch_iter(uid, 'FLAGS'))
+    return ' '.join(msg.flags)
 
 
 @fn_time
 @using()
-def search_thrs(query, con=None):
+def search_thrs(query, *, window=None, con=None):
     criteria = 'INTHREAD REFS (%s) KEYWORD #latest' % query
+    if window:
+        uids, total = sort_window(con, '(REVERSE DATE)', criteria, window)
+        log.debug('## query: %r; threads: %s/%s', query, len(uids), total)
+        return uids, total
+
     res = con.sort('(REVERSE DATE)', criteria)
     uids = res[0].decode().split()
     log.debug('## query: %r; threads: %s', query, len(uids))
@@ -625,20 +1343,74 @@ def thrs_info(uids, tags=None, con=None):
     elif '#spam' in tags:
         special_tag = '#spam'
 
+    summaries = threads_summaries(con, uids)
+    if summaries is None:
+        log.debug('## no thread summaries, using THREAD command')
+        yield from thrs_info_thread(con, uids, special_tag)
+        return
+
+    views = {}
+    metas = {}
+    for key, thr in summaries.items():
+        if thr['view'] and thr['info']:
+            metas[thr['view'][0]] = thr['info']
+        if special_tag:
+            view = index.summary(thr['msgs'], thr['latest'], special_tag)
+        else:
+            view = thr['view']
+        if view:
+            views[key] = view
+
+    missing = {v[0] for v in views.values()} - set(metas)
+    if missing:
+        for uid, _, meta in summary_metas(con, list(missing)):
+            metas[uid] = meta
+
+    for key, (uid, flags, addrs, draft_id) in views.items():
+        thr = summaries[key]
+        info = dict(metas[uid], uids=thr['uids'])
+        if draft_id:
+            info['draft_id'] = draft_id
+        yield thr['latest'], info, flags, addrs
+
+
+def threads_summaries(con, uids, box=ALL):
+    # {key: summary} for threads of given messages in the same order or
+    # None if some of them are not in the thread index; the index isn't
+    # changed here, flags not refreshed by writers yet are applied in memory
+    state = threads_state(con, box)
+    if not state:
+        return None
+    keys = index.get_keys(con, box, 'threads/uids', uids)
+    if len(keys) < len(set(uids)):
+        return None
+    keys = list(dict.fromkeys(keys[i] for i in uids))
+    summaries = index.get_keys(con, box, 'threads/summary', keys)
+    if len(summaries) < len(keys):
+        return None
+    summaries = {k: summaries[k] for k in keys}
+    if state[0] != state[1]:
+        uids = [i for thr in summaries.values() for i in thr['msgs']]
+        flags = changed_flags(con, state[0], uids)
+        summaries_flags(summaries, flags)
+        for thr in summaries.values():
+            view = thr['view']
+            thr['view'] = index.summary(thr['msgs'], thr['latest'])
+            if not view or not thr['view'] or view[0] != thr['view'][0]:
+                thr['info'] = None
+    return summaries
+
+
+def thrs_info_thread(con, uids, special_tag):
     q = 'REFS UTF-8 INTHREAD REFS UID %s' % ','.join(uids)
     thrs = con.thread(q)
     all_flags = {}
     all_msgs = {}
-    res = con.fetch(thrs.all_uids, '(FLAGS BINARY.PEEK[1])')
-    for i in range(0, len(res), 2):
-        uid, flags = re.search(
-            r'UID (\d+) FLAGS \(([^)]*)\)', res[i][0].decode()
-        ).groups()
-        flags = flags.split()
-        if '#link' in flags:
+    for msg in con.fetch_iter(thrs.all_uids, '(FLAGS BINARY.PEEK[1])'):
+        if '#link' in msg.flags:
             continue
-        all_flags[uid] = flags
-        all_msgs[uid] = json.loads(res[i][1])
+        all_flags[msg.uid] = msg.flags
+        all_msgs[msg.uid] = json.loads(msg.body)
 
     for thr in thrs:
         thrid = None
@@ -685,41 +1457,82 @@ def thrs_info(uids, tags=None, con=None):
         yield thrid, info, flags, addrs
 
 
+@fn_time
+@using()
+def update_unread(full=False, save=True, con=None):
+    # Unread counters are updated by flags changed since the last MODSEQ.
+    # Writers (sync and parse) save them under "unread" lock, without
+    # "save" (for GET requests) changes are only counted in memory
+    if not save:
+        return count_unread(con, full)[0]
+
+    try:
+        with user_lock('unread', timeout=None, wait=1):
+            unread, status, full = count_unread(con, full)
+            if status:
+                save_unread(con, unread, status, full)
+            return unread
+    except LockError:
+        log.info('## unread counters are saved by another process')
+        return count_unread(con, full)[0]
+
+
+def count_unread(con, full=False):
+    # (unread, status, full), "status" is None if nothing is changed
+    status = box_status(con, ALL)
+    state = index.get_keys(con, ALL, 'unread/state', list(status))
+    if state.get('uidvalidity') != status['uidvalidity']:
+        full = True
+    elif not full and state['modseq'] == status['modseq']:
+        counts = index.get(con, ALL, 'unread/counts')
+        return index.Unread(counts=counts), None, False
+
+    if full:
+        unread = index.Unread()
+        res = con.search('UNSEEN UNKEYWORD #link')
+        uids = res[0].decode().split()
+        if uids:
+            for msg in con.fetch_iter(uids, '(UID FLAGS)'):
+                unread.update(msg.uid, msg.flags)
+        log.info('## recounted %s unread messages', len(unread.msgs))
+        return unread, status, True
+
+    flags = changed_flags(con, state['modseq'])
+    unread = index.Unread(
+        index.get_keys(con, ALL, 'unread/msgs', flags),
+        index.get(con, ALL, 'unread/counts')
+    )
+    if expunged(status, state, flags):
+        res = con.search('UNSEEN UNKEYWORD #link')
+        tracked = index.get(con, ALL, 'unread/msgs')
+        unread.msgs.update(tracked)
+        for uid in set(tracked) - set(res[0].decode().split()):
+            unread.remove(uid)
+    for uid, msg_flags in flags.items():
+        unread.update(uid, msg_flags)
+    return unread, status, False
+
+
+def save_unread(con, unread, status, full=False):
+    for name, (items, removed) in unread.changes().items():
+        if full:
+            index.replace(con, ALL, name, items)
+        else:
+            index.update(con, ALL, name, items, removed)
+    index.update(con, ALL, 'unread/state', status)
+
+
 @fn_time
 @using()
 def tags_info(con=None):
-    saved_tags.cache_clear()
-    unread = {}
-    hidden = {}
-    res = con.search('UNSEEN UNKEYWORD #link')
-    uids = res[0].decode().split()
-    if uids:
-        res = con.fetch(uids, 'FLAGS')
-        for line in res:
-            flags = re.search(
-                r'FLAGS \(([^)]*)\)', line.decode()
-            ).group(1).split()
-            for f in flags:
-                unread.setdefault(f, 0)
-                unread[f] += 1
-                hide_flags = None
-                if '#trash' in flags:
-                    hide_flags = {'#trash'}
-                elif '#spam' in flags:
-                    hide_flags = {'#spam'}
-                if hide_flags and hide_flags - {f}:
-                    hidden.setdefault(f, 0)
-                    hidden[f] += 1
-    unread = {
-        k: v - hidden.get(k, 0)
-        for k, v in unread.items() if hidden.get(k) != v
-    }
+    unread = update_unread(save=False, con=con).unread()
+    saved = saved_tags()
     tags = {
-        t: dict(get_tag(t), unread=unread.get(t, 0))
+        t: dict(get_tag(t, saved), unread=unread.get(t, 0))
         for t in con.flags
     }
     tags.update({
-        t: dict(tags.get(t, get_tag(t)), pinned=1)
+        t: dict(tags.get(t) or get_tag(t, saved), pinned=1)
         for t in ('#inbox', '#spam', '#trash')
     })
     return tags
@@ -730,6 +1543,7 @@ def tags_info(con=None):
 def del_msg(uid, con=None):
     save_msgids([uid], rm=True)
     pid = pair_origin_uids([uid])[0]
+    forget_threads([pid], con=con)
     for box, uid in ((SRC, uid), (ALL, pid)):
         con.select(box, readonly=False)
         con.store([uid], '+FLAGS.SILENT', '\\Deleted')
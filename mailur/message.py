@@ -1,6 +1,7 @@
 import datetime as dt
 import email
 import email.header
+import email.parser
 import email.policy
 import encodings
 import hashlib
@@ -15,6 +16,9 @@ import chardet
 
 from . import html, log
 
+# should be increased on changes in "parsed" result for the same input
+VERSION = 1
+
 aliases = {
     # Seems Google used gb2312 in some subjects, so there is another symbol
     # instead of dash, because of next bug:
@@ -241,6 +245,34 @@ def parse_mime(orig, uid):
     return htm, txt, files, headers, errors
 
 
+def ref_ids(orig):
+    refs = orig['references']
+    refs = [i.strip().lower() for i in refs.split()] if refs else []
+    parent = refs[-1] if refs else None
+    in_reply_to = orig['in-reply-to'] and orig['in-reply-to'].strip().lower()
+    if in_reply_to:
+        parent = in_reply_to
+        if not refs:
+            refs = [in_reply_to]
+
+    mid = orig['message-id']
+    if mid is not None:
+        mid = mid.strip().lower()
+    return refs, parent, mid
+
+
+def parsed_deps(raw, uid, time, flags, mids):
+    # arguments of "parsed" which affect its result except raw message,
+    # only headers are parsed here
+    orig = email.parser.BytesHeaderParser().parsebytes(raw)
+    refs, _, mid = ref_ids(orig)
+    mid = '<mailur@noid>' if mid is None else mid
+    return [
+        uid, time, '\\Draft' in flags,
+        [r for r in refs if r in mids], mids.get(mid, [None])[0]
+    ]
+
+
 def parsed(raw, uid, time, flags, mids):
     # "email.message_from_bytes" uses "email.policy.compat32" policy
     # and it's by intention, because new policies don't work well
@@ -280,23 +312,13 @@ def parsed(raw, uid, time, flags, mids):
     subj = headers['Subject']
     meta['subject'] = str(subj).strip() if subj else ''
 
-    refs = orig['references']
-    refs = [i.strip().lower() for i in refs.split()] if refs else []
-    parent = refs[-1] if refs else None
-    in_reply_to = orig['in-reply-to'] and orig['in-reply-to'].strip().lower()
-    if in_reply_to:
-        parent = in_reply_to
-        if not refs:
-            refs = [in_reply_to]
+    refs, parent, mid = ref_ids(orig)
     refs = [r for r in refs if r in mids]
     meta['parent'] = parent
 
-    mid = orig['message-id']
     if mid is None:
         log.info('## UID=%s has no "Message-ID" header', uid)
         mid = '<mailur@noid>'
-    else:
-        mid = mid.strip().lower()
     meta['msgid'] = mid
     if mids[mid][0] != uid:
         log.info('## UID=%s duplicate: {%r: %r}', uid, mid, mids[mid])
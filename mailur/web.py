@@ -16,7 +16,7 @@ from bottle import (
     Bottle, abort, redirect, request, response, static_file, template
 )
 
-from . import LockError, conf, html, imap, local, log, message, user_cache
+from . import LockError, conf, html, imap, local, log, message, set_user
 from .schema import validate
 
 root = pathlib.Path(__file__).parent.parent
@@ -28,9 +28,8 @@ app.catchall = not conf['DEBUG']
 def session(callback):
     def inner(*args, **kwargs):
         session = request.get_cookie('session', secret=conf['SECRET'])
+        set_user(session and session['username'])
         if session:
-            conf['USER'] = session['username']
-            user_cache().clear()
             save_session(session)  # refresh max_age
         request.session = session
         return callback(*args, **kwargs)
@@ -215,15 +214,31 @@ def search():
     if opts.get('thread'):
         return thread(q, opts, preload or 4)
 
+    # with "limit" only one page of uids is returned, "cursor" from
+    # the response is used to get the next one
+    window = None
+    limit = request.json.get('limit')
+    if limit:
+        cursor = request.json.get('cursor') or 0
+        if not all(isinstance(i, int) and i >= 0 for i in (cursor, limit)):
+            return abort(400)
+        window = (cursor, limit)
+
     if opts.get('threads'):
-        uids = local.search_thrs(q)
+        uids = local.search_thrs(q, window=window)
         info = ft.partial(local.thrs_info, tags=opts.get('tags'))
         info_url = app.get_url('thrs_info')
     else:
-        uids = local.search_msgs(q)
+        uids = local.search_msgs(q, window=window)
         info = local.msgs_info
         info_url = app.get_url('msgs_info')
 
+    page = {}
+    if window:
+        uids, total = uids
+        cursor = window[0] + len(uids)
+        page = {'total': total, 'cursor': cursor if cursor < total else None}
+
     msgs = {}
     preload = preload or 200
     tags = opts.get('tags', [])
@@ -238,7 +253,7 @@ def search():
         'uids': uids,
         'msgs': msgs,
         'msgs_info': info_url
-    }, **{k: v for k, v in extra.items() if v})
+    }, **{k: v for k, v in extra.items() if v}, **page)
 
 
 @app.post('/thrs/info', name='thrs_info')
@@ -39,14 +39,22 @@ def init(request):
 
 @pytest.fixture(autouse=True)
 def setup(new_users, gm_client, patch):
-    from mailur import cache
+    from mailur import cache, local, set_user
 
-    conf = {'USER': test1}
+    # versions of cached values are checked on every call
+    conf = {'USER': test1, 'CACHE_VERSION_TTL': 0}
     with patch.dict('mailur.conf', conf):
         cache.clear()
+        set_user(None)
 
         yield
 
+        set_user(None)
+
+        for pool in local.pools.values():
+            pool.clear()
+        local.pools.clear()
+
 
 @pytest.fixture
 def new_users():
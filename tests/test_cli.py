@@ -60,6 +60,11 @@ def test_fetch_and_parse(gm_client, login, msgs, patch, raises):
     assert [i['uid'] for i in msgs(local.SRC)] == ['1', '2']
     assert [i['uid'] for i in msgs()] == ['3', '4']
 
+    cli.main('parse %s all --procs=2' % login.user1)
+    assert [i['uid'] for i in msgs(local.SRC)] == ['1', '2']
+    assert [i['uid'] for i in msgs()] == ['5', '6']
+    assert [i['meta']['origin_uid'] for i in msgs()] == ['1', '2']
+
     with patch('mailur.gmail.fetch') as m, raises(SystemExit):
         m.side_effect = SystemExit
         cli.main('gmail %s --parse' % login.user1)
@@ -44,6 +44,17 @@ def test_fn_parse_thread():
         ('130', '131', '132', '133', '134', '138', '139', '140'),
     )
     assert fn(b'(1)(2)(3)') == (('1',), ('2',), ('3',))
+    assert fn('').all_uids == []
+
+    res = fn('(1)(2 3 (4 5)(6))((7)(8))', tree=True)
+    assert res == (('1',), ('2', '3', '4', '5', '6'), ('7', '8'))
+    assert res.all_uids == ['1', '2', '3', '4', '5', '6', '7', '8']
+    assert res.tree == [
+        ('1', []),
+        ('2', [('3', [('4', [('5', [])]), ('6', [])])]),
+        (None, [('7', []), ('8', [])]),
+    ]
+    assert fn('(1)').tree is None
 
 
 def test_fn_pack_uids():
@@ -51,6 +62,98 @@ def test_fn_pack_uids():
     assert fn(['1', '2', '3', '4']) == '1:4'
     assert fn(['1', '3', '4']) == '1,3:4'
     assert fn(['100', '1', '4', '3', '10', '9', '8', '7']) == '1,3:4,7:10,100'
+    assert fn(['2', '1', '2', '5']) == '1:2,5'
+    assert fn([]) == ''
+
+
+def test_fn_parse_esearch():
+    fn = imap.parse_esearch
+    assert fn(None) == {}
+    assert fn(b'(TAG "A1") UID') == {}
+    assert fn(b'(TAG "A1") UID COUNT 0 PARTIAL (1:10 NIL)') == {
+        'count': 0, 'partial': []
+    }
+    assert fn(b'(TAG "A1") UID PARTIAL (1:10 9,3:5,2) COUNT 42') == {
+        'count': 42, 'partial': ['9', '3', '4', '5', '2']
+    }
+    assert fn('(TAG "A1") UID MIN 2 MAX 10 ALL 10:8,2') == {
+        'min': '2', 'max': '10', 'all': ['10', '9', '8', '2']
+    }
+
+
+def test_fn_uids():
+    uids = imap.Uids(['3', '1', '2', '10'])
+    assert uids.str == '1:3,10'
+    assert uids.batches is None
+    assert str(uids) == '"4 uids"'
+
+    uids = imap.Uids('1:*')
+    assert uids.str == '1:*'
+    assert uids.batches is None
+
+    uids = imap.Uids(range(1, 100001))
+    assert uids.str == '1:100000'
+    assert uids.batches is None
+
+    uids = imap.Uids(range(1, 10001), batch=3000)
+    assert [i.str for i in uids.batches] == [
+        '1:3000', '3001:6000', '6001:9000', '9001:10000'
+    ]
+
+    # split by length of encoded sequence set, order is kept
+    uids = list(range(20000, 1, -2))
+    res = imap.Uids(uids, size=1000)
+    assert res.batches
+    assert all(len(i.str) <= 1000 for i in res.batches)
+    assert [j for i in res.batches for j in i.val] == uids
+
+    res = imap.Uids(uids, batch=1000, size=1000)
+    assert all(len(i.val) <= 1000 for i in res.batches)
+    assert all(len(i.str) <= 1000 for i in res.batches)
+    assert [j for i in res.batches for j in i.val] == uids
+
+    res = imap.Uids(uids, batch=1000, threads=1, tune=True)
+    assert res.batches is None
+    res = res.call_async(lambda few: list(few.val), res)
+    assert [i for few in res for i in few] == uids
+
+
+def test_fn_tune(raises):
+    tune = imap.Tune(10, 2, latency=1)
+    res = tune.run(list, list(range(1000)))
+    assert [i for few in res for i in few] == list(range(1000))
+    assert tune.threads > 2
+    assert tune.batch > 10
+
+    tune.update(4, 40, 'reset')
+    tune.success(40, 2)
+    assert (tune.threads, tune.batch) == (2, 20)
+    tune.failure(ValueError())
+    assert (tune.threads, tune.batch) == (1, 10)
+
+    calls = []
+
+    def flaky(few):
+        calls.append(len(few))
+        if len(calls) == 1:
+            raise ValueError('throttled')
+        return list(few)
+
+    tune = imap.Tune(10, 1, latency=1)
+    res = tune.run(flaky, list(range(30)))
+    assert [i for few in res for i in few] == list(range(30))
+    assert calls[:3] == [10, 5, 5]
+
+    tune = imap.Tune(10, 1, retries=1)
+    with raises(ValueError) as e:
+        tune.run(lambda few: 1 / 0, list(range(30)))
+    assert 'Exception in the pool' in str(e)
+
+    calls.clear()
+    uids = imap.Uids(range(1, 31), batch=10, threads=1, tune=True, retries=0)
+    with raises(ValueError):
+        uids.call_async(lambda few: flaky(few.val), uids)
+    assert calls == [10]
 
 
 def test_literal_size_limit(gm_client, raises):
@@ -99,6 +202,15 @@ def test_multiappend(patch, msgs):
     con.multiappend(local.SRC, new, batch=3)
     assert len(msgs(local.SRC)) == 20
 
+    # without LITERAL+ every literal waits for continuation from server
+    assert 'LITERAL+' in con._con.capabilities
+    con._con.capabilities = tuple(
+        i for i in con._con.capabilities if i != 'LITERAL+'
+    )
+    con.multiappend(local.SRC, new)
+    assert len(msgs(local.SRC)) == 30
+    con._con.capabilities += ('LITERAL+',)
+
 
 def test_idle():
     def handler():
@@ -107,3 +219,143 @@ def test_idle():
     con = local.client()
     # just check if timeout works
     assert not con.idle(handler, timeout=1)
+
+
+def test_pool():
+    with local.client() as con:
+        assert con.box == local.ALL
+    with local.client() as con1:
+        assert con1 is con
+    assert local.pool().free == [con]
+
+    with local.client(local.SRC) as con1:
+        assert con1 is con
+        assert con1.box == local.SRC
+        with local.client() as con2:
+            assert con2 is not con
+            assert con2.box == local.ALL
+    assert local.pool().free == [con, con2]
+
+    with local.client(local.SRC) as con1:
+        assert con1 is con
+    with local.client(local.ALL, readonly=False) as con1:
+        assert con1 is con2
+        assert not con1._con.is_readonly
+
+    # broken connections aren't returned to the pool
+    with local.client() as con1:
+        con1.logout()
+    assert local.pool().free == [con]
+
+    with local.client() as con1:
+        assert con1 is con
+        con1.idle(lambda res: None, timeout=1)
+    assert local.pool().free == []
+
+
+def test_fn_parse_fetch():
+    res = [
+        (
+            b'1 (UID 101 INTERNALDATE "08-Jul-2017 09:08:30 +0000" '
+            b'FLAGS (\\Seen #1) BODY[] {3}', b'abc'
+        ),
+        b')',
+        b'2 (UID 5 FLAGS ())',
+        (b'3 (UID 6 BODY[HEADER.FIELDS (MESSAGE-ID)] {2}', b'\r\n'),
+        (b' BINARY[2.1] {1}', b'x'),
+        b' FLAGS (#a))'
+    ]
+    msgs = list(imap.parse_fetch(res))
+    assert [m.uid for m in msgs] == ['101', '5', '6']
+    assert [m.flags for m in msgs] == [['\\Seen', '#1'], [], ['#a']]
+    assert [m.time for m in msgs] == [
+        '"08-Jul-2017 09:08:30 +0000"', None, None
+    ]
+    assert [m.body for m in msgs] == [b'abc', None, b'\r\n']
+    assert msgs[2].parts == {
+        'BODY[HEADER.FIELDS (MESSAGE-ID)]': b'\r\n',
+        'BINARY[2.1]': b'x'
+    }
+
+    # literal8 for BINARY[] items
+    res = [
+        (b'1 (UID 7 BINARY[1] ~{3}', b'a\x00b'),
+        (b' BINARY[2] ~{1}', b'c'),
+        b' FLAGS (\\Seen))'
+    ]
+    msg = list(imap.parse_fetch(res))[0]
+    assert (msg.uid, msg.flags) == ('7', ['\\Seen'])
+    assert msg.parts == {'BINARY[1]': b'a\x00b', 'BINARY[2]': b'c'}
+    res = [(b'2 (UID 8 BINARY[1] ~{1}', b'd'), b')']
+    assert list(imap.parse_fetch(res))[0].body == b'd'
+
+    res = [
+        b'1 (X-GM-MSGID 10 X-GM-LABELS ("\\\\Inbox" "a \\"b\\"" (c) d) '
+        b'UID 2 MODSEQ (33) FLAGS () BODY[1] NIL BODY[2] "")'
+    ]
+    msg = list(imap.parse_fetch(res))[0]
+    assert (msg.uid, msg.flags, msg.modseq) == ('2', [], '33')
+    assert msg.attrs == {
+        'X-GM-MSGID': '10',
+        'X-GM-LABELS': ['\\Inbox', 'a "b"', ['c'], 'd']
+    }
+    assert msg.parts == {'BODY[1]': None, 'BODY[2]': b''}
+
+
+def test_fn_tokenize_fetch():
+    fn = imap.tokenize_fetch
+    assert fn('1 (UID 1 FLAGS (\\Seen #1))') == [
+        '1', '(', 'UID', '1', 'FLAGS', '(', '\\Seen', '#1', ')', ')'
+    ]
+    assert fn('1 (INTERNALDATE "08-Jul (2017)" UID 1)') == [
+        '1', '(', 'INTERNALDATE', '"08-Jul (2017)', 'UID', '1', ')'
+    ]
+    assert fn('1 (BODY[HEADER.FIELDS (MESSAGE-ID)] {2} UID 1)') == [
+        '1', '(', 'BODY[HEADER.FIELDS (MESSAGE-ID)]', '{2}', 'UID', '1', ')'
+    ]
+    assert fn('1 (X-GM-LABELS ("a \\"b\\"" c))') == [
+        '1', '(', 'X-GM-LABELS', '(', '"a \\"b\\"', 'c', ')', ')'
+    ]
+
+
+def test_fetch_iter(gm_client):
+    gm_client.add_emails([{}] * 3)
+    con = local.client()
+    res = con.fetch('1:*', '(FLAGS BINARY.PEEK[1])')
+    msgs = list(con.fetch_iter('1:*', '(FLAGS BINARY.PEEK[1])'))
+    assert [m.uid for m in msgs] == ['1', '2', '3']
+    assert [m.body for m in msgs] == [res[i][1] for i in range(0, 6, 2)]
+
+    msgs = con.fetch_iter('1:*', 'FLAGS')
+    assert next(msgs).uid == '1'
+    msgs.close()
+    assert [m.uid for m in con.fetch_iter('2', 'FLAGS')] == ['2']
+    assert list(con.fetch_iter([], 'FLAGS')) == []
+
+
+def test_pipeline(gm_client, patch):
+    gm_client.add_emails([{}] * 3)
+    con = local.client()
+    res = con.pipeline([
+        'UID SEARCH ALL',
+        'UID FETCH 1:2 (UID)',
+        'UID FETCH 3 (UID)',
+        'UID WRONG',
+    ])
+    assert res[0] == ('OK', [b'1 2 3'])
+    assert res[1] == ('OK', [b'1 (UID 1)', b'2 (UID 2)'])
+    assert res[2] == ('OK', [b'3 (UID 3)'])
+    assert res[3][0] == 'BAD'
+    assert con.search('ALL') == [b'1 2 3']
+
+    with patch.object(imap.Uids, 'max_size', 2):
+        assert con.fetch(['1', '3', '2'], '(UID)') == [
+            b'1 (UID 1)', b'3 (UID 3)', b'2 (UID 2)'
+        ]
+        msgs = list(con.fetch_iter(['1', '3', '2'], 'FLAGS'))
+        assert sorted(m.uid for m in msgs) == ['1', '2', '3']
+
+        msgs = con.fetch_iter(['1', '3', '2'], 'FLAGS')
+        assert next(msgs).uid == '1'
+        msgs.close()
+        assert con.search('ALL') == [b'1 2 3']
@@ -0,0 +1,303 @@
+from gevent import joinall, sleep, spawn
+
+from mailur import imap, index, local, message
+
+
+def test_fn_sqlite(tmp_path, patch):
+    db = index.SQLite(str(tmp_path))
+    assert db.get(None, 'Src', 'test') == {}
+
+    db.update(None, 'Src', 'test', {'a': ['1'], 'b': {'c': 'd'}})
+    assert db.get(None, 'Src', 'test') == {'a': ['1'], 'b': {'c': 'd'}}
+    assert db.get(None, 'All', 'test') == {}
+    assert db.get(None, 'Src', 'test2') == {}
+
+    db.update(None, 'Src', 'test', {'c': 3}, rm=['a', 'x'])
+    assert db.get(None, 'Src', 'test') == {'b': {'c': 'd'}, 'c': 3}
+
+    assert db.get_keys(None, 'Src', 'test', ['c', 'x']) == {'c': 3}
+    assert db.get_keys(None, 'Src', 'test', []) == {}
+
+    db.replace(None, 'Src', 'test', {'d': 4})
+    assert db.get(None, 'Src', 'test') == {'d': 4}
+
+    db.update(None, 'All', 'test', {'e': 5})
+    db.update(None, 'All.next', 'test', {'f': 6})
+    db.move(None, 'All.next', 'All')
+    assert db.get(None, 'All', 'test') == {'f': 6}
+    assert db.get(None, 'All.next', 'test') == {}
+
+    with patch.dict('mailur.conf', {'USER': 'another'}):
+        assert db.get(None, 'Src', 'test') == {}
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_fn_write_lock(patch):
+    events = []
+
+    def write(i):
+        with index.write_lock():
+            events.append(('in', i))
+            sleep(0.01)
+            with index.write_lock():
+                events.append(('nested', i))
+            events.append(('out', i))
+
+    with patch.dict('mailur.conf', {'USER': 'lock'}):
+        joinall([spawn(write, i) for i in range(3)], raise_error=True)
+    assert events == [
+        (e, i) for i in range(3) for e in ('in', 'nested', 'out')
+    ]
+
+
+def test_fn_parse_cache(tmp_path):
+    cache = index.ParseCache(str(tmp_path), 1)
+    assert cache.get('a', ['1']) is None
+
+    cache.update([('a', ['1'], b'msg', ['#err']), ('b', ['2'], b'', [])])
+    assert cache.get('a', ['1']) == (b'msg', ['#err'])
+    assert cache.get('a', ['2']) is None
+    assert cache.get('b', ['2']) == (b'', [])
+
+    cache = index.ParseCache(str(tmp_path), 2)
+    assert cache.get('a', ['1']) is None
+    assert cache.db().execute('SELECT count(*) FROM parsed').fetchone() == (0,)
+
+
+def test_fn_parsed_deps():
+    raw = (
+        b'Message-ID: <2@mlr>\r\n'
+        b'References: <1@mlr> <0@mlr>\r\n'
+        b'Subject: test\r\n\r\nbody'
+    )
+    mids = {'<1@mlr>': ['1'], '<2@mlr>': ['2']}
+    assert message.parsed_deps(raw, '2', 'time', [], mids) == [
+        '2', 'time', False, ['<1@mlr>'], '2'
+    ]
+    assert message.parsed_deps(b'\r\nbody', '3', 'time', ['\\Draft'], {}) == [
+        '3', 'time', True, [], None
+    ]
+
+
+def test_fn_threads():
+    def load(thrs):
+        changes = thrs.changes()
+        return index.Threads(*(
+            changes[i][0] for i in ('threads', 'threads/ids', 'threads/uids')
+        ))
+
+    thrs = index.Threads()
+    thrs.add('1', 10, False, ['<1>'])
+    thrs.add('2', 20, False, ['<2>', '<1>'])
+    thrs.add('3', 5, False, ['<3>'])
+    thrs.add('3', 5, False, ['<3>'])
+    assert thrs.latest() == ({'2', '3'}, set())
+    assert thrs.threads == {
+        '1': {
+            'msgs': {
+                '1': [10, False, ['<1>']],
+                '2': [20, False, ['<2>', '<1>']]
+            },
+            'latest': '2', 'date': 20
+        },
+        '3': {'msgs': {'3': [5, False, ['<3>']]}, 'latest': '3', 'date': 5}
+    }
+
+    # a link joins two threads, but it's never the latest
+    thrs = load(thrs)
+    thrs.add('4', 30, True, ['<4>', '<1>', '<3>'])
+    assert thrs.latest() == (set(), {'3'})
+    assert list(thrs.threads) == ['1']
+    assert thrs.threads['1']['latest'] == '2'
+    assert thrs.changes()['threads'][1] == ['3']
+    assert thrs.uids == {'1': '1', '2': '1', '3': '1', '4': '1'}
+
+    # threads are split back without the link
+    thrs = load(thrs)
+    thrs.remove('4')
+    thrs.remove('4')
+    assert thrs.latest() == ({'3'}, set())
+    assert sorted(thrs.threads) == ['1', '3']
+    assert '<4>' not in thrs.ids
+    assert thrs.changes()['threads/ids'][1] == ['<4>']
+
+    # a key of thread is changed with removed message
+    thrs = load(thrs)
+    thrs.remove('1')
+    assert thrs.latest() == (set(), set())
+    assert sorted(thrs.threads) == ['2', '3']
+    assert thrs.ids['<1>'] == '2'
+    assert sorted(thrs.changes()['threads'][1]) == ['1']
+
+    thrs = load(thrs)
+    thrs.remove('2')
+    assert thrs.latest() == (set(), set())
+    assert thrs.changes()['threads'] == ({}, ['2'])
+    assert thrs.changes()['threads/uids'] == ({}, ['2'])
+
+
+def test_fn_summary():
+    a, b, c = ({'addr': i} for i in 'abc')
+    msgs = {
+        '1': [10, ['\\Seen'], a, None],
+        '3': [30, ['#latest'], c, None],
+        '2': [20, ['\\Draft', '\\Seen'], b, '<draft>'],
+    }
+    assert index.summary(msgs, '3') == (
+        '3', ['#latest', '\\Draft'], [a, b, c], '<draft>'
+    )
+    assert index.summary(msgs, '3', '#trash') is None
+
+    msgs['3'][1] = ['#latest', '#trash', '\\Seen']
+    assert index.summary(msgs, '3') == (
+        '2', ['\\Draft', '\\Seen'], [a, b], '<draft>'
+    )
+    assert index.summary(msgs, '3', '#trash') == (
+        '3', ['#latest', '#trash', '\\Seen'], [c], None
+    )
+    assert index.summary(msgs, '3', '#spam') is None
+    assert index.summary({}, '3') is None
+
+
+def test_fn_unread():
+    unread = index.Unread()
+    unread.update('1', ['#inbox', 't1'])
+    unread.update('2', ['#inbox', '#trash'])
+    unread.update('3', ['#inbox', '\\Seen'])
+    unread.update('4', ['#link'])
+    assert unread.unread() == {'#inbox': 1, 't1': 1, '#trash': 1}
+    assert sorted(unread.msgs) == ['1', '2']
+
+    # counters are loaded from the index and updated by changes
+    changes = unread.changes()
+    unread = index.Unread(*(
+        changes[i][0] for i in ('unread/msgs', 'unread/counts')
+    ))
+    unread.update('1', ['#inbox', 't1', '\\Seen'])
+    unread.update('2', ['#inbox'])
+    unread.remove('5')
+    assert unread.unread() == {'#inbox': 1}
+    assert sorted(unread.changes()['unread/counts'][1]) == ['#trash', 't1']
+    assert unread.changes()['unread/msgs'] == ({'2': ['#inbox']}, ['1'])
+
+    unread.remove('2')
+    assert unread.unread() == {}
+    assert unread.counts == {}
+
+
+def test_fn_bitmaps():
+    bitmaps = index.Bitmaps()
+    bitmaps.update({
+        '1': ['#inbox', '\\Seen'],
+        '2': ['#inbox', '#trash'],
+        '3': ['#inbox', '\\Flagged'],
+    }, {'1': 30, '2': 10, '3': 20})
+    bitmaps.update({'5': []}, {'5': 20})
+    bitmaps.update({'6': ['\\Seen']}, {'6': -2 ** 40})
+
+    def search(q, reverse=True):
+        terms = index.Bitmaps.parse(q)
+        return bitmaps.uids(bitmaps.search(terms), reverse=reverse)
+
+    assert search('all') == ['1', '5', '3', '2', '6']
+    assert search('ALL', reverse=False) == ['6', '2', '3', '5', '1']
+    bitmaps.expunge(['1', '2', '3', '5'])
+    assert search('keyword #inbox unseen unkeyword #trash') == ['3']
+    assert search('keyword #inbox flagged') == ['3']
+    assert search('unflagged unkeyword #trash') == ['1', '5']
+    assert search('uid 2:3,5') == ['5', '3', '2']
+    assert search('uid 3:* seen') == []
+    assert search('uid 1:4000000000') == ['1', '5', '3', '2']
+    assert search('uid 4000000000') == []
+    assert search('uid 4000000000:*') == ['5']
+    assert search('keyword #none') == []
+
+    # flags are replaced on update, dates are kept
+    bitmaps.update({'2': ['\\Seen']})
+    assert search('seen') == ['1', '2']
+    assert search('keyword #trash') == []
+    bitmaps.expunge(['1', '3'])
+    assert search('all') == ['1', '3']
+    assert search('uid 2:*') == ['3']
+    bitmaps.expunge([])
+    assert search('uid 1:*') == []
+
+    assert index.Bitmaps.parse('text "test" unkeyword #trash') is None
+    assert index.Bitmaps.parse('uid') is None
+    assert index.Bitmaps.parse('or seen flagged') is None
+    assert index.Bitmaps.parse('all') == []
+
+
+def test_fn_uidmap():
+    uids = index.UidMap({'10': '3', '2': '1', '7': '20'})
+    assert uids == {'2': '1', '7': '20', '10': '3'}
+    assert list(uids) == ['2', '7', '10']
+    assert uids['10'] == '3'
+    assert '7' in uids
+    assert '3' not in uids
+    assert 'x' not in uids
+    assert uids.get('11') is None
+    assert uids.inverse() == {'1': '2', '20': '7', '3': '10'}
+    assert index.UidMap() == {}
+    assert index.UidMap().inverse() == {}
+
+
+def test_fn_midmap(patch):
+    mids = {'<a@x>': ['2', '10'], '<b@x>': ['3'], '<ф@x>': ['4']}
+    res = index.MidMap(mids)
+    assert res == mids
+    assert len(res) == 3
+    assert res['<a@x>'] == ['2', '10']
+    assert res.get('<c@x>') is None
+    assert '<b@x>' in res
+    assert 1 not in res
+    assert index.MidMap() == {}
+
+    with patch.object(index.MidMap, 'hash', staticmethod(len)):
+        res = index.MidMap(mids)
+        assert len(set(res.hashes)) == 1
+        assert res == mids
+        assert res['<b@x>'] == ['3']
+        assert res['<ф@x>'] == ['4']
+        assert '<c@x>' not in res
+
+
+def test_metadata():
+    con = local.client(None)
+    db = index.Metadata(shards=4)
+    assert db.get(con, 'Src', 'test') == {}
+
+    db.update(con, 'Src', 'test', {str(i): [str(i)] for i in range(20)})
+    assert db.get(con, 'Src', 'test') == {
+        str(i): [str(i)] for i in range(20)
+    }
+    res = con.getmetadata('Src', 'index/test', depth=1)
+    assert len(imap.parse_metadata(res)) == 4
+
+    db.update(con, 'Src', 'test', {'1': ['2']}, rm=['2', '3'])
+    data = db.get(con, 'Src', 'test')
+    assert len(data) == 18
+    assert data['1'] == ['2']
+    assert '2' not in data
+    assert db.get_keys(con, 'Src', 'test', ['1', '2', '4']) == {
+        '1': ['2'], '4': ['4']
+    }
+
+    db.replace(con, 'Src', 'test', {'a': 1})
+    assert db.get(con, 'Src', 'test') == {'a': 1}
+    assert db.get(con, 'All', 'test') == {}
+
+
+def test_sqlite_local(gm_client, tmp_path, patch):
+    conf = {'INDEX': 'sqlite', 'INDEX_PATH': str(tmp_path)}
+    with patch.dict('mailur.conf', conf):
+        gm_client.add_emails([{}] * 2)
+        assert local.uid_pairs() == (
+            {'1': '1', '2': '2'}, {'1': '1', '2': '2'}
+        )
+        assert sorted(local.msgids().values()) == [['1'], ['2']]
+        local.save_msgids(['2'], rm=True)
+        assert sorted(local.msgids().values()) == [['1']]
+
+    local.uid_pairs.cache_clear()
+    assert local.uid_pairs() == ({}, {})
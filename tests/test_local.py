@@ -1,4 +1,222 @@
-from mailur import local
+from gevent import sleep, spawn
+from gevent.pool import Pool
+
+from mailur import (
+    Cache, conf, fn_cache, get_user, imap, index, local, message, set_user,
+    sizeof, snapshots
+)
+
+
+def test_fn_cache(patch):
+    calls = []
+    version = ['1']
+
+    @fn_cache(version=lambda size: version[0])
+    def get(size):
+        calls.append(size)
+        return 'x' * size
+
+    with patch('mailur.cache', Cache()) as cache:
+        with patch.dict(conf, {'USER': 'u1', 'CACHE_USER_SIZE': 3000}):
+            assert get(1000) == get(1000)
+            assert calls == [1000]
+            get(1001)
+            get(1002)
+            assert calls == [1000, 1001, 1002]
+            assert get(1002) and calls == [1000, 1001, 1002]
+            # the least recently used one is evicted
+            assert cache.stats()['counters']['get'] == {
+                'hits': 2, 'misses': 3, 'stale': 0, 'evictions': 1
+            }
+            assert get(1000) and calls[-1] == 1000
+            assert get(5000) and calls[-1] == 5000
+            assert get(5000) and calls[-1] == 5000
+
+            version[0] = '2'
+            get(1002)
+            assert calls[-1] == 1002
+            assert cache.stats()['counters']['get']['stale'] == 1
+
+        with patch.dict(conf, {'USER': 'u2', 'CACHE_TTL': -1}):
+            get(1)
+            get(1)
+            assert calls[-2:] == [1, 1]
+            get.cache_clear()
+            assert list(cache.sizes) == ['u1']
+
+        with patch.dict(conf, {'USER': 'u1', 'CACHE_SIZE': 2000}):
+            get(1500)
+            assert cache.size == sizeof('x' * 1500)
+            assert len(cache.entries) == 1
+
+        cache.clear()
+        assert cache.stats()['size'] == 0
+
+        # version isn't checked again for "CACHE_VERSION_TTL" seconds
+        versions = []
+
+        @fn_cache(version=lambda: versions.append(1) or version[0])
+        def get_one():
+            return len(calls)
+
+        with patch.dict(conf, {'USER': 'u1', 'CACHE_VERSION_TTL': 60}):
+            assert get_one() == get_one()
+            assert len(versions) == 1
+            version[0] = '3'
+            assert get_one() == len(calls) and len(versions) == 1
+            get_one.cache_clear()
+            get_one()
+            assert len(versions) == 2
+
+
+def test_fn_cache_shared(tmp_path, patch):
+    calls = []
+    version = [1, 10]
+
+    @fn_cache(version=lambda: tuple(version), shared=True)
+    def get():
+        calls.append(1)
+        return index.UidMap({'1': '2', '3': '4'})
+
+    opts = {'USER': 'u1', 'CACHE_PATH': str(tmp_path)}
+    with patch.dict(conf, opts):
+        with patch('mailur.cache', Cache()):
+            assert get() == {'1': '2', '3': '4'}
+        assert len(calls) == 1
+        snapshot = tmp_path / 'u1' / snapshots.name(get)
+        assert list((tmp_path / 'u1').iterdir()) == [snapshot]
+
+        # another worker with empty cache reads the snapshot
+        with patch('mailur.cache', Cache()) as cache:
+            assert get() == {'1': '2', '3': '4'}
+            assert get().inverse() == {'2': '1', '4': '3'}
+        assert len(calls) == 1
+        assert cache.stats()['counters']['get']['hits'] == 1
+
+        version[1] = 11
+        with patch('mailur.cache', Cache()):
+            get()
+            assert len(calls) == 2
+            get()
+            assert len(calls) == 2
+
+            get.cache_clear()
+            assert list((tmp_path / 'u1').iterdir()) == []
+            snapshot.write_bytes(b'[1, 11]')
+            get()
+            assert len(calls) == 3
+
+        # snapshots writable by others are never loaded
+        with patch('mailur.cache', Cache()):
+            get()
+        snapshot.chmod(0o666)
+        with patch('mailur.cache', Cache()):
+            get()
+            assert len(calls) == 4
+
+        snapshot.chmod(0o600)
+        (tmp_path / 'u1').chmod(0o777)
+        with patch('mailur.cache', Cache()):
+            get()
+            assert len(calls) == 5
+        assert (tmp_path / 'u1').stat().st_mode & 0o777 == 0o777
+
+
+def test_fn_user(patch):
+    @fn_cache
+    def name():
+        sleep(0.01)
+        return get_user()
+
+    def request(user):
+        set_user(user)
+        sleep(0.01)
+        res = [get_user(), name()]
+        res += Pool(2).map(lambda i: get_user(), range(3))
+        res.append(spawn(spawn(get_user).get).get())
+        return res
+
+    with patch('mailur.cache', Cache()):
+        jobs = [spawn(request, 'u%s' % i) for i in range(10)]
+        assert [j.get() for j in jobs] == [['u%s' % i] * 6 for i in range(10)]
+
+        assert get_user() == conf['USER']
+        set_user('u1')
+        assert get_user() == 'u1'
+        assert name() == 'u1'
+        set_user(None)
+        assert get_user() == conf['USER']
+
+
+def test_fn_pipe(raises):
+    pipe = local.Pipe(10)
+    sizes = []
+
+    def produce():
+        for i in [3, 4, 5, 20, 1, 2]:
+            pipe.put(i, i)
+            sizes.append(pipe.size)
+        pipe.close()
+        return 'produced'
+
+    def consume():
+        res = []
+        for i in pipe:
+            sleep(0.001)
+            res.append(i)
+        return res
+
+    res = local.pipeline(produce, consume)
+    assert res == ['produced', [3, 4, 5, 20, 1, 2]]
+    assert max(sizes) == 20
+    assert all(i <= 10 for i in sizes if i != 20)
+
+    pipe = local.Pipe(10)
+
+    def fail():
+        for i in pipe:
+            raise ValueError(i)
+
+    sizes.clear()
+    with raises(ValueError):
+        local.pipeline(produce, fail)
+    # the producer is killed while waiting for room
+    assert sizes == [3, 7, 9]
+
+    # pipes of concurrent pipelines share one budget
+    budget = local.Budget(10)
+    pipes = [local.Pipe(budget=budget) for i in range(3)]
+    sizes = []
+
+    def produce_to(pipe):
+        for i in [4, 4, 4]:
+            pipe.put(i, i)
+            sizes.append(budget.size)
+        pipe.close()
+
+    def consume_from(pipe):
+        for i in pipe:
+            sleep(0.001)
+
+    jobs = [spawn(produce_to, p) for p in pipes]
+    jobs += [spawn(consume_from, p) for p in pipes]
+    for j in jobs:
+        j.get()
+    assert len(sizes) == 9
+    assert max(sizes) <= 10
+    assert budget.size == 0
+
+
+def test_fn_sort_date():
+    time = '"01-Jan-2000 00:00:00 +0000"'
+    header = b'Date: Thu, 01 Jan 1970 00:00:10 +0000'
+    assert local.sort_date(header, time) == 10
+    # "-0000" zone is UTC, not local time
+    header = b'Date: Thu, 01 Jan 1970 00:00:10 -0000'
+    assert local.sort_date(header, time) == 10
+    header = b'Date: Mon, 01 Jan 1900 00:00:00 +0000'
+    assert local.sort_date(header, time) == -2208988800
+    assert local.sort_date(b'Subject: no date', time) == 946684800
 
 
 def test_uid_pairs(gm_client, msgs, patch):
@@ -53,6 +271,62 @@ def test_uid_pairs(gm_client, msgs, patch):
         assert m.call_args[0][0] == '9'
 
 
+def test_data_version(gm_client):
+    gm_client.add_emails([{}])
+    assert local.uid_pairs()[0] == {'1': '1'}
+    version = local.data_version(local.ALL, 'uidpairs')
+    gm_client.add_emails([{}], parse=False)
+    assert local.data_version(local.ALL, 'uidpairs') == version
+
+    # another worker saves the index, so local cache isn't cleared
+    with local.client(None) as con:
+        index.update(con, local.ALL, 'uidpairs', {'5': '6'})
+        local.save_data_version(con, local.ALL, 'uidpairs')
+    assert local.uid_pairs()[0] == {'1': '1', '5': '6'}
+
+    tags = local.saved_tags()
+    with local.client(None) as con:
+        con.setmetadata(local.SRC, 'tags', '{"#t": {"name": "t"}}')
+        local.save_data_version(con, local.SRC, 'tags')
+    assert local.saved_tags() != tags
+
+
+def test_save_addrs(gm_client, patch):
+    gm_client.add_emails([
+        {'from': 'a@t.com', 'to': 'b@t.com'}, {'from': 'c@t.com'}
+    ])
+    assert sorted(local.get_addrs()[1]) == ['a@t.com', 'b@t.com', 'c@t.com']
+
+    # the whole address book isn't loaded for new messages
+    with patch('mailur.index.get', wraps=index.get) as m:
+        local.save_addrs(['2'])
+        assert not m.called
+    assert sorted(local.get_addrs()[1]) == ['a@t.com', 'b@t.com', 'c@t.com']
+
+
+def test_parse_all(gm_client, msgs):
+    gm_client.add_emails([{}, {'in_reply_to': '<101@mlr>'}])
+    with local.client(None) as con:
+        index.replace(con, local.ALL, 'uidpairs', {'1': '2'})
+        index.replace(con, local.ALL, 'threads/uids', {})
+        index.replace(con, local.ALL, 'threads/state', {})
+        local.save_data_version(con, local.ALL, 'uidpairs')
+
+    # indexes are rebuilt for the whole box
+    local.parse('all')
+    assert ['3', '4'] == [i['uid'] for i in msgs()]
+    assert local.uid_pairs() == ({'1': '3', '2': '4'}, {'3': '1', '4': '2'})
+    with local.client() as con:
+        uidvalidity = str(local.box_state(con, local.ALL)[0])
+        state = index.get(con, local.ALL, 'threads/state')
+        assert state['uidvalidity'] == uidvalidity
+        assert state['modseq']
+        keys = index.get(con, local.ALL, 'threads/uids')
+        assert sorted(keys) == ['3', '4']
+        assert len(set(keys.values())) == 1
+    assert [i['flags'] for i in msgs()] == ['', '#latest']
+
+
 def test_update_threads(gm_client, msgs):
     gm_client.add_emails([{'subj': 'new subj'}])
     res = msgs()
@@ -117,6 +391,161 @@ def test_update_threads(gm_client, msgs):
         '', '', '', '', '#latest', '#latest', '#latest t1', '#latest t2'
     ]
 
+    # the index is the same as THREAD REFS result
+    con.select(local.ALL)
+    thrs = con.thread('REFS UTF-8 ALL')
+    idx = index.get(con, local.ALL, 'threads')
+    assert sorted(sorted(t['msgs']) for t in idx.values()) == sorted(
+        sorted(t) for t in thrs
+    )
+    assert index.get(con, local.ALL, 'threads/uids') == {
+        uid: key for key, t in idx.items() for uid in t['msgs']
+    }
+
+
+def test_thread_summaries(gm_client, msgs, patch):
+    def check(uids, special_tag=None):
+        with local.client() as con:
+            expected = {
+                thrid: (info, sorted(flags), addrs)
+                for thrid, info, flags, addrs
+                in local.thrs_info_thread(con, uids, special_tag)
+            }
+        tags = [special_tag] if special_tag else None
+        res = {
+            thrid: (info, sorted(flags), addrs)
+            for thrid, info, flags, addrs in local.thrs_info(uids, tags)
+        }
+        assert res.keys() == expected.keys()
+        for thrid, (info, flags, addrs) in res.items():
+            uids = list(expected[thrid][0].pop('uids'))
+            assert info.pop('uids') == uids
+            assert (info, flags, addrs) == expected[thrid]
+        return res
+
+    gm_client.add_emails([
+        {'from': 'a@t.com'},
+        {'from': 'b@t.com', 'in_reply_to': '<101@mlr>'},
+        {'from': 'c@t.com', 'refs': '<101@mlr> <102@mlr>'},
+        {'from': 'd@t.com'},
+    ])
+    with local.client() as con:
+        assert local.threads_summaries(con, ['1', '4'])
+    res = check(['1', '4'])
+    assert sorted(res) == ['3', '4']
+    assert len(res['3'][2]) == 3
+    assert '\\Seen' not in res['3'][1]
+
+    # flags are refreshed by CONDSTORE without reparsing
+    local.msgs_flag(['1', '2', '3'], [], ['\\Seen'])
+    res = check(['2'])
+    assert '\\Seen' in res['3'][1]
+
+    local.msgs_flag(['3'], [], ['#trash'])
+    res = check(['3'])
+    assert res['3'][0]['from']['addr'] == 'b@t.com'
+    res = check(['3'], '#trash')
+    assert res['3'][0]['from']['addr'] == 'c@t.com'
+    assert len(res['3'][2]) == 1
+    check(['4'], '#spam')
+    res = check(['4', '3'])
+    assert list(res) == ['4', '3']
+
+    # reading doesn't change the index, flags stored by another client
+    # are applied in memory until a writer refreshes the index
+    with local.client(readonly=False) as con:
+        con.store(['3'], '-FLAGS.SILENT', '#trash')
+    with patch('mailur.index.update') as m, patch('mailur.index.replace'):
+        res = check(['3'])
+        assert res['3'][0]['from']['addr'] == 'c@t.com'
+        assert not m.called
+    local.msgs_flag(['4'], [], ['\\Flagged'])
+    with local.client() as con:
+        state = local.threads_state(con, local.ALL)
+        assert state[0] == state[1]
+    res = check(['3', '4'])
+    assert '\\Flagged' in res['4'][1]
+
+    # membership changes with a new message
+    gm_client.add_emails([{'from': 'e@t.com', 'refs': '<104@mlr>'}])
+    res = check(['4'])
+    assert len(res['5'][2]) == 2
+
+
+def test_update_unread(gm_client, msgs, patch):
+    def unread():
+        res = local.update_unread().unread()
+        return {k: res[k] for k in ('#inbox', '#trash', 't1') if k in res}
+
+    gm_client.add_emails([{'labels': 't1'}, {}, {}])
+    assert unread() == {'#inbox': 3, 't1': 1}
+
+    local.msgs_flag(['1'], [], ['\\Seen'])
+    local.msgs_flag(['2'], [], ['#trash'])
+    assert unread() == {'#inbox': 1, '#trash': 1}
+
+    # expunged messages are found by amount of messages
+    local.parse('uid 3')
+    assert unread() == {'#inbox': 1, '#trash': 1}
+    full = local.update_unread(full=True).unread()
+    assert local.update_unread().unread() == full
+    with local.client() as con:
+        assert sorted(index.get(con, local.ALL, 'unread/msgs')) == ['2', '4']
+
+    # reading doesn't change the index, changes are counted in memory
+    local.msgs_flag(['4'], [], ['\\Seen'])
+    with patch('mailur.index.update') as m, patch('mailur.index.replace'):
+        res = local.update_unread(save=False).unread()
+        assert res.get('#inbox', 0) == 0
+        local.tags_info()
+        assert not m.called
+
+    # the lock is taken by another process, so counters aren't saved
+    with local.user_lock('unread'), patch('mailur.index.update') as m:
+        assert local.update_unread().unread() == res
+        assert not m.called
+    assert local.update_unread().unread() == res
+    with local.client() as con:
+        assert sorted(index.get(con, local.ALL, 'unread/msgs')) == ['2']
+
+
+def test_search_bitmaps(gm_client, msgs):
+    gm_client.add_emails([{'labels': 't1'}, {}, {}, {'date': 1}])
+    local.msgs_flag(['1'], [], ['\\Seen'])
+    local.msgs_flag(['2'], [], ['#trash', '\\Flagged'])
+
+    def check(q, sort='(REVERSE DATE)'):
+        with local.client() as con:
+            expected = con.sort(sort, q)[0].decode().split()
+            assert local.search_bitmaps(con, q, sort) == expected
+        return expected
+
+    assert check('all') == ['3', '2', '1', '4']
+    assert check('all', '(DATE)') == ['4', '1', '2', '3']
+    assert check('keyword #inbox unseen unkeyword #trash') == ['3', '4']
+    assert check('flagged') == ['2']
+    assert check('keyword t1 unkeyword #trash unkeyword #spam') == ['1']
+    assert check('uid 2:*') == ['3', '2', '4']
+
+    # changes are applied by MODSEQ
+    local.msgs_flag(['3'], [], ['\\Flagged'])
+    assert check('flagged unkeyword #trash') == ['3']
+
+    # a snapshot is versioned by MODSEQ, so changes of another process
+    # aren't missed by workers loading it
+    bitmaps = local.flag_bitmaps()
+    with local.client(readonly=False) as con:
+        con.store(['1'], '-FLAGS.SILENT', '\\Seen')
+        assert local.flag_bitmaps() is bitmaps
+        assert bitmaps.flags.get('\\Seen', 0) == 0
+    local.parse('uid 4')
+    assert check('all') == ['3', '2', '1', '5']
+    assert local.search_msgs('uid 1:3', window=(1, 1)) == (['2'], 3)
+
+    with local.client() as con:
+        assert local.search_bitmaps(con, 'text "42"', '(DATE)') is None
+        assert local.search_bitmaps(con, 'all', '(ARRIVAL)') is None
+
 
 def thread(box=local.SRC, criteria='ALL'):
     with local.client(box) as con:
@@ -398,6 +827,85 @@ def test_link_threads_part3(gm_client, msgs):
     assert local.search_thrs('uid 1') == [i[0] for i in local.thrs_info(['1'])]
 
 
+def test_parse_cache(gm_client, msgs, patch, tmp_path):
+    with patch.dict('mailur.conf', {'PARSE_CACHE': str(tmp_path)}):
+        gm_client.add_emails([{}, {'flags': '\\Draft'}])
+        assert [i['uid'] for i in msgs()] == ['1', '2']
+
+        with patch('mailur.message.parsed', wraps=message.parsed) as m:
+            local.parse('all')
+            assert [i['uid'] for i in msgs()] == ['3', '4']
+            # drafts are not cached
+            assert m.call_count == 1
+
+            with patch('mailur.message.VERSION', 2):
+                local.index.backends.clear()
+                m.reset_mock()
+                local.parse('all')
+                assert [i['uid'] for i in msgs()] == ['5', '6']
+                assert m.call_count == 2
+
+
+def test_reparse(gm_client, msgs, patch):
+    gm_client.add_emails([{}, {'flags': '\\Flagged'}])
+    assert [i['uid'] for i in msgs()] == ['1', '2']
+    with local.client(None) as con:
+        uidvalidity = local.box_state(con, local.ALL)[0]
+    with local.client() as con_all:
+        assert con_all.box == local.ALL
+    # a pool of another process, it isn't dropped by reparse
+    other = imap.ConnPool(local.pool().create)
+    with other.get(local.ALL):
+        pass
+
+    local.reparse()
+    # pooled connections with old "All" selected aren't reused
+    assert con_all not in local.pool().free
+    with local.client() as con:
+        assert con is not con_all
+    res = msgs()
+    assert [i['uid'] for i in res] == ['1', '2']
+    assert [i['meta']['origin_uid'] for i in res] == ['1', '2']
+    assert '\\Flagged' in res[1]['flags']
+    assert all('#latest' in i['flags'] for i in res)
+    assert local.uid_pairs() == ({'1': '1', '2': '2'}, {'1': '1', '2': '2'})
+    with local.client(None) as con:
+        assert local.box_state(con, local.ALL)[0] != uidvalidity
+        assert con.list('""', 'All.*') == [None]
+
+    gm_client.add_emails([{}])
+    assert [i['uid'] for i in msgs()] == ['1', '2', '3']
+    assert local.pair_origin_uids(['3']) == ('3',)
+
+    # a connection pooled before the swap sees the new "All"
+    with other.get(local.ALL) as con:
+        assert con._con.uidvalidity != uidvalidity
+        assert con.search('ALL')[0].decode().split() == ['1', '2', '3']
+    other.clear()
+
+    # Src changes while reparsing are caught up before the swap,
+    # "parse" lock is free until then
+    changed = []
+    save_addrs = local.save_addrs
+
+    def change(*a, **kw):
+        if not changed:
+            changed.append(1)
+            with local.user_lock('parse'):
+                pass
+            gm_client.add_emails([{}], parse=False)
+            with local.client(local.SRC, readonly=False) as con:
+                con.store(['1'], '+FLAGS.SILENT', '\\Seen')
+        return save_addrs(*a, **kw)
+
+    with patch('mailur.local.save_addrs', change):
+        local.reparse()
+    res = msgs()
+    assert [i['meta']['origin_uid'] for i in res] == ['1', '2', '3', '4']
+    assert '\\Seen' in res[0]['flags']
+    assert local.pair_origin_uids(['4']) == ('4',)
+
+
 def test_msgids(gm_client, msgs, some, load_file, latest):
     gm_client.add_emails([{'mid': '<zero@mlr>'} for i in range(0, 8)])
     gm_client.add_emails([
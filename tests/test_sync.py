@@ -82,6 +82,111 @@ def test_local(gm_client, msgs):
     ]
 
 
+def test_incremental(gm_client, msgs, patch):
+    gm_client.add_emails([{}] * 5)
+    con_src = local.client(local.SRC, readonly=False)
+    con_all = local.client(local.ALL, readonly=False)
+
+    with patch('mailur.local.store_flags', wraps=local.store_flags) as m:
+        con_src.store('1:*', '+FLAGS', '#1')
+        local.sync_flags_to_all()
+        assert not m.called
+        assert [i['flags'] for i in msgs()] == ['#latest #1'] * 5
+
+        con_src.store('2', '+FLAGS', '#2')
+        con_all.store('4', '+FLAGS', '#3')
+        local.sync_flags_to_all()
+        assert m.call_count == 1
+        assert m.call_args[0][2] == {'2': '2', '4': '4'}
+        assert [i['flags'] for i in msgs()] == [
+            '#latest #1', '#latest #1 #2', '#latest #1',
+            '#latest #1', '#latest #1'
+        ]
+
+        # own STOREs of the previous pass aren't synced again
+        m.reset_mock()
+        local.sync_flags_to_all()
+        assert m.call_count == 1
+        assert m.call_args[0][2] == {}
+
+        m.reset_mock()
+        con_all.store('1', '+FLAGS', '\\Seen')
+        local.sync_flags_to_src()
+        assert not m.called
+        assert [i['flags'] for i in msgs(local.SRC)][0] == '\\Seen #1'
+        con_all.store('3', '+FLAGS', '#4')
+        local.sync_flags_to_src()
+        assert m.call_args[0][2] == {'3': '3'}
+        assert [i['flags'] for i in msgs(local.SRC)][2] == '#1 #4'
+
+        m.reset_mock()
+        local.sync_flags_to_all(full=True)
+        assert not m.called
+
+
+def test_idle_resume(gm_client, msgs, patch):
+    gm_client.add_emails([{}] * 3)
+    con_src = local.client(local.SRC, readonly=False)
+
+    job = spawn(local.sync_flags)
+    sleep(1)
+    con_src.store('1', '+FLAGS', '#1')
+    sleep(1)
+    assert [i['flags'] for i in msgs()] == ['#latest #1', '#latest', '#latest']
+    state = local.flags_state(con_src, local.SRC, local.ALL)
+    job.kill()
+
+    con_src.store('2', '+FLAGS', '#2')
+    with patch('mailur.local.store_flags', wraps=local.store_flags) as m:
+        job = spawn(local.sync_flags)
+        sleep(1)
+        assert m.called
+        assert '2' in m.call_args[0][2]
+        assert '3' not in m.call_args[0][2]
+    assert [i['flags'] for i in msgs()] == [
+        '#latest #1', '#latest #2', '#latest'
+    ]
+    new_state = local.flags_state(con_src, local.SRC, local.ALL)
+    assert new_state[local.SRC][1] > state[local.SRC][1]
+
+    con_src.store('3', '+FLAGS', '#3')
+    sleep(1)
+    assert [i['flags'] for i in msgs()] == [
+        '#latest #1', '#latest #2', '#latest #3'
+    ]
+    job.kill()
+
+
+def test_idle_both(gm_client, msgs, patch):
+    gm_client.add_emails([{}] * 5)
+    con_src = local.client(local.SRC, readonly=False)
+    con_all = local.client(local.ALL, readonly=False)
+
+    job = spawn(local.sync_flags)
+    sleep(1)
+    with patch('mailur.local.store_flags', wraps=local.store_flags) as m:
+        for i in range(1, 6):
+            con_all.store(str(i), '+FLAGS', '\\Seen')
+        sleep(1)
+        # one pass for all of them
+        assert m.call_args_list[1][0][2] == {
+            str(i): str(i) for i in range(1, 6)
+        }
+    assert [i['flags'] for i in msgs(local.SRC)] == ['\\Seen'] * 5
+
+    con_src.store('1', '+FLAGS', '#1')
+    con_all.store('1', '+FLAGS', '#2')
+    con_all.store('2', '+FLAGS', '#2')
+    sleep(1)
+    assert [i['flags'] for i in msgs(local.SRC)][:2] == [
+        '\\Seen #1', '\\Seen #2'
+    ]
+    assert [i['flags'] for i in msgs()][:2] == [
+        '\\Seen #latest #1', '\\Seen #latest #2'
+    ]
+    job.kill()
+
+
 def test_cli_idle(gm_client, msgs, login, patch):
     with patch('mailur.gmail.get_credentials') as m:
         m.return_value = login.user2, 'user'
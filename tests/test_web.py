@@ -437,6 +437,35 @@ def test_msgs_flag(gm_client, login, msgs):
     ]
 
 
+def test_search_window(gm_client, login):
+    gm_client.add_emails([{'labels': '\\Inbox'}] * 5)
+    web = login()
+    res = web.search({'q': '', 'preload': 1, 'limit': 2})
+    assert res['uids'] == ['5', '4']
+    assert list(res['msgs']) == ['5']
+    assert (res['total'], res['cursor']) == (5, 2)
+
+    res = web.search({'q': '', 'limit': 2, 'cursor': 2})
+    assert res['uids'] == ['3', '2']
+    assert (res['total'], res['cursor']) == (5, 4)
+    res = web.search({'q': '', 'limit': 2, 'cursor': 4})
+    assert res['uids'] == ['1']
+    assert (res['total'], res['cursor']) == (5, None)
+    res = web.search({'q': '', 'limit': 2, 'cursor': 6})
+    assert res['uids'] == []
+    assert (res['total'], res['cursor']) == (5, None)
+
+    res = web.search({'q': ':threads', 'limit': 3})
+    assert res['uids'] == ['5', '4', '3']
+    assert (res['total'], res['cursor']) == (5, 3)
+    assert res['threads']
+
+    res = web.search({'q': ''})
+    assert res['uids'] == ['5', '4', '3', '2', '1']
+    assert 'total' not in res
+    web.search({'q': '', 'limit': 2, 'cursor': -1}, status=400)
+
+
 def test_search_thread(gm_client, login, some):
     def post(uid, preload=4):
         data = {'q': 'thread:%s' % uid, 'preload': preload}